@@ -0,0 +1,98 @@
+import argparse
+import itertools
+import json
+import platform
+import random
+import time
+import tracemalloc
+
+from knapsack import *
+from solver import *
+
+FLAGS = ["use_rub", "use_locb", "use_cache", "use_dominance", "compact", "headless"]
+
+def dd_stats(summaries):
+    stats = {
+        "dds": len(summaries),
+        "restricted_dds": sum(1 for summary in summaries if not summary.relaxed),
+        "relaxed_dds": sum(1 for summary in summaries if summary.relaxed),
+        "nodes": sum(summary.nodes() for summary in summaries),
+    }
+    for name in DELETION_REASONS:
+        stats["deleted_by_" + name] = sum(summary.deleted[name] for summary in summaries)
+    return stats
+
+def run(instance, settings, trace_memory, seconds):
+    model = KnapsackModel(instance)
+    # only keep a summary of each diagram, as a long run would do
+    summaries = []
+    solver = Solver(model, KnapsackDominance(), settings, callback=lambda dd: summaries.append(dd.summary()))
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    solver.solve(budget=Budget(seconds=seconds))
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    result = {
+        "best": solver.input.best,
+        "bound": solver.bound(),
+        "stopped": solver.stopped, # "seconds" when the run was cut off by --time
+        "time": elapsed,
+        "peak_memory": peak,
+    }
+    result.update(dd_stats(summaries))
+    if settings.profile:
+        result["profile"] = solver.profile.to_json()["phases"]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DD compilation and branch-and-bound on random knapsack instances.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 20])
+    parser.add_argument("--widths", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--instances", type=int, default=2, help="instances per size")
+    parser.add_argument("--flags", nargs="*", choices=FLAGS, default=["use_rub", "use_cache", "compact"], help="flags whose combinations are run, the others are off")
+    parser.add_argument("--time", type=float, default=10, help="time budget of each run in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory", action="store_true", help="trace memory, tracing slows down the runs")
+    parser.add_argument("--profile", action="store_true", help="record the time spent in each compilation phase")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sizes:
+        # one generator per size so that adding sizes does not change the other instances
+        rand = random.Random(args.seed * 1000003 + n)
+        for i in range(args.instances):
+            instance = KnapsackInstance.random(n, rand)
+            for width in args.widths:
+                for cutset in Cutset:
+                    for values in itertools.product([False, True], repeat=len(args.flags)):
+                        flags = dict.fromkeys(FLAGS, False)
+                        flags.update(zip(args.flags, values))
+                        settings = Settings(width, cutset, profile=args.profile, **flags)
+
+                        result = {"n": n, "instance": i, "width": width, "cutset": cutset.name}
+                        result.update(flags)
+                        result.update(run(instance, settings, args.memory, args.time))
+                        results.append(result)
+
+                        print("n={n} instance={instance} width={width} cutset={cutset} ".format(**result) \
+                            + " ".join(name for name in FLAGS if flags[name]) \
+                            + " time={:.3f}s dds={}".format(result["time"], result["dds"]) \
+                            + (" stopped" if result["stopped"] is not None else ""), flush=True)
+
+    with open(args.output, "w") as fd:
+        json.dump({
+            "python": platform.python_version(),
+            "seed": args.seed,
+            "time_budget": args.time,
+            "results": results,
+        }, fd, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import os
+import pickle
+import struct
+import time
+from array import array
+
+from dd import *
+
+# a checkpoint file is MAGIC followed by sections, each one a header (name, number of rows, number
+# of columns) and its columns, a column is a typecode and the bytes of an array of that type, or
+# 'p' and a pickled list when the values do not fit one, e.g. states of models without state_of(),
+# long tables are written as several sections of at most CHUNK rows so that they are streamed
+
+MAGIC = b"DDCKPT1\n"
+CHUNK = 1 << 16
+
+SECTION = struct.Struct("<8sQB")
+COLUMN = struct.Struct("<cQ")
+
+NO_PATH = -2 # path id of an unknown path, -1 is the empty path of the root
+
+class Checkpoint:
+    # writes the state of a search to file every seconds and/or every nodes subproblems, the file
+    # is replaced atomically so that a crash while writing keeps the previous checkpoint
+    def __init__(self, file, seconds=60, nodes=math.inf):
+        self.file = file
+        self.seconds = seconds
+        self.nodes = nodes
+        self.last_time = time.perf_counter()
+        self.last_nodes = 0
+        self.written = 0
+
+    def due(self, solver):
+        return time.perf_counter() - self.last_time >= self.seconds or solver.explored - self.last_nodes >= self.nodes
+
+    def tick(self, solver):
+        if self.due(solver):
+            self.write(solver)
+
+    def write(self, solver):
+        tmp = self.file + ".tmp"
+        with open(tmp, "wb") as fd:
+            write_checkpoint(solver, fd)
+        os.replace(tmp, self.file)
+        self.last_time = time.perf_counter()
+        self.last_nodes = solver.explored
+        self.written += 1
+
+def write_column(fd, values, typecode):
+    try:
+        data = array(typecode, values).tobytes()
+    except (TypeError, OverflowError):
+        typecode = "p"
+        data = pickle.dumps(list(values), pickle.HIGHEST_PROTOCOL)
+    fd.write(COLUMN.pack(typecode.encode(), len(data)))
+    fd.write(data)
+
+def read_column(fd):
+    (typecode, size) = COLUMN.unpack(fd.read(COLUMN.size))
+    data = fd.read(size)
+    if typecode == b"p":
+        return pickle.loads(data)
+    values = array(typecode.decode())
+    values.frombytes(data)
+    return values
+
+def write_section(fd, name, columns):
+    # columns are (values, typecode) pairs of the same length
+    rows = len(columns[0][0]) if len(columns) > 0 else 0
+    for start in range(0, max(rows, 1), CHUNK):
+        fd.write(SECTION.pack(name.encode(), min(CHUNK, rows - start), len(columns)))
+        for (values, typecode) in columns:
+            write_column(fd, values[start:start + CHUNK], typecode)
+
+def read_sections(fd):
+    # yields (name, columns) of each section, the chunks of a table are not merged
+    if fd.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not a checkpoint file")
+    while True:
+        header = fd.read(SECTION.size)
+        if len(header) < SECTION.size:
+            return
+        (name, rows, count) = SECTION.unpack(header)
+        yield (name.rstrip(b"\0").decode(), [read_column(fd) for _ in range(count)])
+
+class PathTable:
+    # the paths (see path_of()) as a tree of (parent id, decision) rows, shared prefixes are written once
+    def __init__(self):
+        self.ids = dict()
+        self.parents = []
+        self.decisions = []
+        self.paths = [] # keeps the paths alive so that their id() is not reused
+
+    def id(self, path):
+        if path is None:
+            return NO_PATH
+        added = []
+        while len(path) > 0 and id(path) not in self.ids:
+            added.append(path)
+            path = path[1]
+        parent = -1 if len(path) == 0 else self.ids[id(path)]
+        for path in reversed(added):
+            self.ids[id(path)] = len(self.paths)
+            self.paths.append(path)
+            self.parents.append(parent)
+            self.decisions.append(path[0])
+            parent = len(self.paths) - 1
+        return parent
+
+def read_paths(parents, decisions, paths):
+    for i in range(len(parents)):
+        paths.append((decisions[i], () if parents[i] == -1 else paths[parents[i]]))
+
+def path_by_id(paths, i):
+    if i == NO_PATH:
+        return None
+    if i == -1:
+        return ()
+    return paths[i]
+
+def write_checkpoint(solver, fd):
+    # open subproblems (those being compiled included), thresholds of the cache and incumbent,
+    # the dominance store is not saved, losing it only loses pruning
+    model = solver.input.model
+    nodes = [node for node in solver.queue.nodes() + solver.active if node.ub > solver.input.best]
+    table = PathTable()
+    node_paths = [table.id(node.path) for node in nodes]
+    best_path = table.id(solver.best_path)
+
+    fd.write(MAGIC)
+    write_section(fd, "solver", [
+        ([model.nb_variables()], "q"),
+        ([solver.input.best], "d"),
+        ([solver.explored], "q"),
+        ([best_path], "q"),
+        ([-math.inf if solver.best_path_value is None else solver.best_path_value], "d"),
+    ])
+    write_section(fd, "paths", [(table.parents, "q"), (table.decisions, "q")])
+    if hasattr(model, "state_of"):
+        states = state_keys(model, [node.state for node in nodes])
+    else:
+        states = [node.state for node in nodes]
+    write_section(fd, "frontier", [
+        (states, "q"),
+        ([node.depth for node in nodes], "q"),
+        ([node.value_top for node in nodes], "d"),
+        ([node.ub for node in nodes], "d"),
+        (node_paths, "q"),
+    ])
+    keys = []
+    thetas = []
+    tops = []
+    pruning = []
+    for key, threshold in solver.input.cache.items():
+        keys.append(key)
+        thetas.append(threshold.theta)
+        tops.append(threshold.value_top)
+        pruning.append(threshold.pruning)
+    write_section(fd, "cache", [(keys, "q"), (thetas, "d"), (tops, "d"), (pruning, "B")])
+
+def read_checkpoint(solver, fd):
+    # restores what write_checkpoint() saved into a solver built with the same model, the
+    # frontier nodes are added to its queue and the thresholds to its cache
+    model = solver.input.model
+    paths = []
+    best_path = NO_PATH
+    for (name, columns) in read_sections(fd):
+        if name == "solver":
+            (nb_variables, best, explored, best_path, best_path_value) = (column[0] for column in columns)
+            if nb_variables != model.nb_variables():
+                raise ValueError("checkpoint of a model with {} variables instead of {}".format(nb_variables, model.nb_variables()))
+            solver.input.best = number(best)
+            solver.explored = explored
+            solver.best_path_value = None if best_path_value == -math.inf else number(best_path_value)
+        elif name == "paths":
+            read_paths(columns[0], columns[1], paths)
+        elif name == "frontier":
+            (states, depths, tops, ubs, node_paths) = columns
+            if hasattr(model, "state_of"):
+                states = [model.state_of(key) for key in states]
+            for i in range(len(states)):
+                solver.enqueue(Node(states[i], depths[i], number(tops[i]), ub=number(ubs[i]), path=path_by_id(paths, node_paths[i])))
+        elif name == "cache":
+            (keys, thetas, tops, pruning) = columns
+            for i in range(len(keys)):
+                solver.input.cache[keys[i]] = Threshold(number(thetas[i]), number(tops[i]), pruning[i] == 1)
+    solver.best_path = path_by_id(paths, best_path)
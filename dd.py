@@ -1,12 +1,24 @@
+import bisect
+import heapq
 import math
+import operator
+import sys
+import time
+from array import array
+from collections import OrderedDict
 from enum import Enum
 
 class Cutset(Enum):
     LAYER = 0
     FRONTIER = 1
 
+class Eviction(Enum):
+    LRU = 0
+    DEPTH = 1
+    PRUNING = 2
+
 class CompilationInput:
-    def __init__(self, model, dominance_rule, root, best, cache, dominance, relaxed, settings):
+    def __init__(self, model, dominance_rule, root, best, cache, dominance, relaxed, settings, rubs=None):
         self.model = model
         self.dominance_rule = dominance_rule
         self.root = root
@@ -15,8 +27,39 @@ class CompilationInput:
         self.dominance = dominance
         self.relaxed = relaxed
         self.settings = settings
+        self.rubs = rubs # optional BoundCache
+        self.adapted_width = None # set by the solver when it adapts the width to each subproblem
+        self.interrupt = None # called with the diagram between two layers, returns the name of a limit to abandon it, see Budget
+
+    @property
+    def width(self):
+        return self.settings.width if self.adapted_width is None else self.adapted_width
+
+class Interrupted(Exception):
+    # raised by Diagram.compile() when input.interrupt() returns a limit, the subproblem is left unexplored
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.limit = limit
+
+def rank_by_value_top(node):
+    return node.value_top
+
+# flags of the nodes, packed in Node.flags and in the flags column of an ArrayLayer
+RELAXED = 1
+MERGED = 2
+CUTSET = 4
+ABOVE_CUTSET = 8
+DELETED_BY_RUB = 16
+DELETED_BY_LOCAL_BOUNDS = 32
+DELETED_BY_CACHE = 64
+DELETED_BY_DOMINANCE = 128
+
+def flag_property(flag):
+    return property(lambda self: self.flags & flag != 0, lambda self, value: self.set_flag(flag, value))
 
 class Arc:
+    __slots__ = ["parent", "reward", "decision", "opt"]
+
     def __init__(self, parent, reward, decision):
         self.parent = parent
         self.reward = reward
@@ -24,8 +67,12 @@ class Arc:
         self.opt = False
         
 class Node:
-    def __init__(self, state, depth=0, value_top=0, arc=None, relaxed=False, merged=False, ub=math.inf):
+    # the boolean attributes are packed in flags, as in ArrayLayer
+    __slots__ = ["state", "key", "depth", "value_top", "value_bot", "theta", "rub", "ub", "arcs", "best_arc", "flags", "deleted_by_hint", "path", "trail", "row"]
+
+    def __init__(self, state, depth=0, value_top=0, arc=None, relaxed=False, merged=False, ub=math.inf, key=None, path=None):
         self.state = state
+        self.key = state if key is None else key
         self.depth = depth
         self.value_top = value_top
         self.value_bot = -math.inf
@@ -35,15 +82,27 @@ class Node:
         self.arcs = []
         if arc is not None:
             self.arcs.append(arc)
-        self.relaxed = relaxed
-        self.merged = merged
-        self.cutset = False
-        self.above_cutset = False
-        self.deleted_by_rub = False
-        self.deleted_by_local_bounds = False
-        self.deleted_by_cache = False
-        self.deleted_by_dominance = False
+        self.best_arc = arc # first arc that gives value_top, kept when the arcs are released
+        self.flags = (RELAXED if relaxed else 0) | (MERGED if merged else 0)
         self.deleted_by_hint = None
+        self.path = path # see path_of()
+        self.trail = None # PathTrail that keeps best_arc at row once the layer is detached
+        self.row = -1
+
+    def set_flag(self, flag, value):
+        if value:
+            self.flags |= flag
+        else:
+            self.flags &= ~flag
+
+    relaxed = flag_property(RELAXED)
+    merged = flag_property(MERGED)
+    cutset = flag_property(CUTSET)
+    above_cutset = flag_property(ABOVE_CUTSET)
+    deleted_by_rub = flag_property(DELETED_BY_RUB)
+    deleted_by_local_bounds = flag_property(DELETED_BY_LOCAL_BOUNDS)
+    deleted_by_cache = flag_property(DELETED_BY_CACHE)
+    deleted_by_dominance = flag_property(DELETED_BY_DOMINANCE)
 
     def __lt__(self, other):
         return self.ub > other.ub
@@ -55,12 +114,101 @@ class Node:
             + ((",theta=" + str(self.theta)) if self.theta != math.inf else "") \
             + (",relaxed" if self.relaxed else "") + ">"
 
+# a path gives the decisions from the root of the search to a node as nested (decision, path of
+# the parent) pairs, so that the paths of nodes with a common ancestor share it, () is the root,
+# they are only built for the nodes that need one, the incumbent and the cutset nodes
+
+def path_of(node):
+    # path of a best way to reach node, walking up the best arcs until a node whose path is
+    # known, which is memoized on the nodes on the way
+    walked = []
+    while node.path is None:
+        if node.trail is not None:
+            node = node.trail.view(node.row)
+        arc = node.best_arc
+        if arc is None:
+            break
+        walked.append((node, arc.decision))
+        node = arc.parent
+    path = () if node.path is None else node.path
+    for node, decision in reversed(walked):
+        path = (decision, path)
+        node.path = path
+    return path
+
+def extend_path(path, decisions):
+    for decision in decisions:
+        path = (decision, path)
+    return path
+
+def path_decisions(path):
+    decisions = []
+    while len(path) > 0:
+        (decision, path) = path
+        decisions.append(decision)
+    decisions.reverse()
+    return decisions
+
+def state_keys(model, states):
+    # layers and the cache are keyed by the packed keys of the states when the model
+    # declares them, a key must be equal for equal states only
+    if hasattr(model, "keys"):
+        return model.keys(states)
+    return states
+
+def state_key(model, state):
+    return state_keys(model, [state])[0]
+
+def key_depth(model):
+    # depth of a state key, None when the keys are packed by a model without depth_of()
+    if not hasattr(model, "keys"):
+        return lambda state: state.depth
+    return getattr(model, "depth_of", None)
+
+def rough_upper_bounds(input, states, keys, depth):
+    # only the bounds missing from input.rubs are computed when it is given
+    model = input.model
+    if input.rubs is None:
+        missing = range(len(states))
+        rubs = [None] * len(states)
+    else:
+        rubs = [input.rubs.get(key) for key in keys]
+        missing = [i for i in range(len(states)) if rubs[i] is None]
+        if len(missing) == 0:
+            return rubs
+    if hasattr(model, "rough_upper_bounds"):
+        computed = model.rough_upper_bounds([states[i] for i in missing], depth)
+    else:
+        computed = [model.rough_upper_bound(states[i]) for i in missing]
+    for i, rub in zip(missing, computed):
+        rubs[i] = rub
+        if input.rubs is not None:
+            input.rubs[keys[i]] = rub
+    return rubs
+
+# orders in which the filters are applied to each new layer, a filter only sees the nodes left by
+# the previous ones, the default one computes the rough upper bounds last, the other one applies
+# the filters that are the cheapest for the knapsack first
+FILTERS = ["cache", "dominance", "rub"]
+CHEAP_FILTERS_FIRST = ["rub", "cache", "dominance"]
+
+DELETION_REASONS = ["dominance", "cache", "rub", "shrink", "local_bounds"]
+
+def retains_deleted(settings, reason):
+    # pruned nodes are only needed by the thresholds, the others are kept for visualization
+    if not settings.headless:
+        return True
+    return reason != "shrink" and settings.use_cache
+
 class Layer:
+    __slots__ = ["input", "nodes", "depth", "deleted_by_dominance", "deleted_by_cache", "deleted_by_rub", "deleted_by_shrink", "deleted_by_local_bounds", "deleted_counts"]
+
     def __init__(self, input, depth, root=None):
         self.input = input
         self.nodes = dict()
         if root is not None:
-            self.nodes[root.state] = root
+            root.key = state_key(input.model, root.state)
+            self.nodes[root.key] = root
         self.depth = depth
 
         self.deleted_by_dominance = []
@@ -68,48 +216,67 @@ class Layer:
         self.deleted_by_rub = []
         self.deleted_by_shrink = []
         self.deleted_by_local_bounds = []
+        self.deleted_counts = dict.fromkeys(DELETION_REASONS, 0)
     
     def next(self):
         next = Layer(self.input, self.depth + 1)
+        if hasattr(self.input.model, "successors_batch"):
+            nodes = list(self.nodes.values())
+            (parents, decisions, rewards, states) = self.input.model.successors_batch([node.state for node in nodes], self.depth)
+            keys = state_keys(self.input.model, states)
+            for i in range(len(states)):
+                node = nodes[parents[i]]
+                next.insert(Node(states[i], next.depth, node.value_top + rewards[i], Arc(node, rewards[i], decisions[i]), node.relaxed, key=keys[i]))
+            return next
         for node in self.nodes.values():
             for decision in self.input.model.domain(node.state, self.depth):
                 state = self.input.model.successor(node.state, decision)
                 if state is None:
                     continue
                 reward = self.input.model.reward(node.state, decision)
-                next.insert(Node(state, next.depth, node.value_top + reward, Arc(node, reward, decision), node.relaxed))
+                next.insert(Node(state, next.depth, node.value_top + reward, Arc(node, reward, decision), node.relaxed, key=state_key(self.input.model, state)))
         return next
 
     def insert(self, node):
-        current = self.nodes.get(node.state)
+        current = self.nodes.get(node.key)
         if current is None:
             current = node
-            self.nodes[current.state] = current
+            self.nodes[current.key] = current
         else:
             current.arcs.append(node.arcs[0])
-            current.value_top = max(current.value_top, node.value_top)
-            current.relaxed |= node.relaxed
+            if node.value_top > current.value_top:
+                current.value_top = node.value_top
+                current.best_arc = node.best_arc
+            current.flags |= node.flags & RELAXED
 
     def shrink(self):
-        order = sorted(self.nodes.values(), key=lambda n: n.value_top, reverse=True)
+        (best, rest) = self.select(self.input.width)
         if self.input.relaxed:
-            self.relax(order)
+            self.relax(best, rest)
         else:
-            self.restrict(order)
+            self.restrict(rest)
+
+    def select(self, k):
+        # k best nodes according to the ranking without sorting the whole layer,
+        # ties are broken by insertion order and the other nodes keep insertion order
+        best = heapq.nlargest(k, self.nodes.values(), key=self.input.settings.ranking)
+        kept = set(map(id, best))
+        return (best, [node for node in self.nodes.values() if id(node) not in kept])
     
-    def restrict(self, order):
-        for node in order[self.input.settings.width:]:
-            self.deleted_by_shrink.append(node)
-            del self.nodes[node.state]
+    def restrict(self, rest):
+        for node in rest:
+            self.delete(node, "shrink")
     
-    def relax(self, order):
-        relax_start = self.input.settings.width - 1
-        self.relax_helper(order[relax_start:], Node(order[relax_start].state.clone(), order[relax_start].depth, relaxed=True, merged=True))
+    def relax(self, best, rest):
+        pivot = best[-1]
+        self.relax_helper([pivot] + rest, Node(pivot.state.clone(), pivot.depth, relaxed=True, merged=True))
     
     def finalize(self):
         nodes = list(self.nodes.values())
         if self.width() > 0:
             self.relax_helper(nodes, Node(nodes[0].state.clone(), nodes[0].depth, relaxed=False))
+            if self.input.settings.headless:
+                return
         
             current = next(iter(self.nodes.values()))
             while len(current.arcs) > 0:
@@ -122,81 +289,49 @@ class Layer:
     def relax_helper(self, to_merge, merged):
         for node in to_merge:
             self.input.model.merge(merged.state, node.state)
+            if merged.best_arc is None or node.value_top > merged.value_top:
+                merged.best_arc = node.best_arc
             merged.value_top = max(merged.value_top, node.value_top)
             merged.arcs.extend(node.arcs)
-            merged.relaxed |= node.relaxed
-            self.deleted_by_shrink.append(node)
-            del self.nodes[node.state]
+            merged.flags |= node.flags & RELAXED
+            self.delete(node, "shrink")
+        merged.key = state_key(self.input.model, merged.state)
         self.insert(merged)
+
+    def delete(self, node, reason, hint=None):
+        # in headless mode, only the nodes needed to compute thresholds are kept
+        self.deleted_counts[reason] += 1
+        if retains_deleted(self.input.settings, reason):
+            getattr(self, "deleted_by_" + reason).append(node)
+            node.deleted_by_hint = hint
+        del self.nodes[node.key]
     
     def filter_with_dominance(self):
         if not self.input.settings.use_dominance:
             return False
         if self.input.dominance_rule is None:
             return False
+        rule = self.input.dominance_rule
         used = False
-        order = sorted(self.nodes.values(), key=lambda n: (self.input.dominance_rule.value(n.state), n.value_top), reverse=True)
-        for i in range(len(order)):
-            node = order[i]
-            if node.relaxed:
-                continue
+        order = sorted(self.nodes.values(), key=lambda n: (rule.value(n.state), n.value_top), reverse=True)
+        groups = dict()
+        for node in order:
+            if not node.relaxed:
+                groups.setdefault(rule.key(node.state), []).append(node)
 
-            dominated = False
-            others = self.input.dominance.get(self.input.dominance_rule.key(node.state))
-            if others is None:
-                others = []
-                self.input.dominance[self.input.dominance_rule.key(node.state)] = others
-
-            j = 0
-            while j < len(others):
-                cmp = self.input.dominance_rule.check(node.state, others[j].state)
-                if cmp == 0:
-                    if self.input.dominance_rule.use_value():
-                        if node.value_top >= others[j].value_top:
-                            del others[j]
-                        else:
-                            node.theta = others[j].value_top - 1
-                            node.deleted_by_dominance = True
-                            node.deleted_by_hint = others[j]
-                            self.deleted_by_dominance.append(node)
-                            del self.nodes[node.state]
-                            dominated = True
-                            break
-                    else:
-                        del others[j]
-                elif cmp > 0:
-                    if self.input.dominance_rule.use_value():
-                        if node.value_top >= others[j].value_top:
-                            del others[j]
-                        else:
-                            j += 1
-                    else:
-                        del others[j]
-                elif cmp < 0:
-                    if self.input.dominance_rule.use_value():
-                        if node.value_top <= others[j].value_top:
-                            node.theta = others[j].value_top
-                            node.deleted_by_dominance = True
-                            node.deleted_by_hint = others[j]
-                            self.deleted_by_dominance.append(node)
-                            del self.nodes[node.state]
-                            dominated = True
-                            break
-                        else:
-                            j += 1
-                    else:
-                        node.theta = math.inf
-                        node.deleted_by_dominance = True
-                        node.deleted_by_hint = others[j]
-                        self.deleted_by_dominance.append(node)
-                        del self.nodes[node.state]
-                        dominated = True
-                        break
-            
-            if dominated:
-                used = True
-            else:
-                others.append(node)
+        for key, nodes in groups.items():
+            store = self.input.dominance.get(key)
+            if store is None:
+                store = dominance_store(rule, self.input.settings)
+                self.input.dominance[key] = store
+
+            results = store.add_all([node.state for node in nodes], [node.value_top for node in nodes], nodes)
+            for node, dominated in zip(nodes, results):
+                if dominated is not None:
+                    node.theta = dominated[1]
+                    node.deleted_by_dominance = True
+                    self.delete(node, "dominance", dominated[0])
+                    used = True
         return used
     
     def filter_with_cache(self):
@@ -206,13 +341,12 @@ class Layer:
         used_larger = False
         used_pruning = False
         for node in list(self.nodes.values()):
-            threshold = self.input.cache.get(node.state)
+            threshold = self.input.cache.get(node.key)
             if threshold is not None and node.value_top <= threshold.theta:
                 node.theta = threshold.theta
                 node.deleted_by_cache = True
-                node.deleted_by_hint = threshold.theta
-                self.deleted_by_cache.append(node)
-                del self.nodes[node.state]
+                self.delete(node, "cache", threshold.theta)
+                self.input.cache.pruned(node.key)
                 used = True
                 used_larger |= node.value_top > threshold.value_top
                 used_pruning |= threshold.pruning
@@ -222,14 +356,14 @@ class Layer:
         if not self.input.settings.use_rub:
             return False
         used = False
-        for node in list(self.nodes.values()):
-            node.rub = self.input.model.rough_upper_bound(node.state)
+        nodes = list(self.nodes.values())
+        rubs = rough_upper_bounds(self.input, [node.state for node in nodes], [node.key for node in nodes], self.depth)
+        for node, rub in zip(nodes, rubs):
+            node.rub = rub
             if node.value_top + node.rub <= self.input.best:
                 node.theta = self.input.best - node.rub
                 node.deleted_by_rub = True
-                node.deleted_by_hint = self.input.best
-                self.deleted_by_rub.append(node)
-                del self.nodes[node.state]
+                self.delete(node, "rub", self.input.best)
                 used = True
         return used
     
@@ -242,6 +376,18 @@ class Layer:
                     arc.parent.cutset = True
                     arc.parent.above_cutset = True
                 arc.parent.above_cutset |= node.above_cutset
+
+    def mark_frontier(self):
+        # forward version of frontier(), the marks of the layer above are final once this one is
+        for node in self.nodes.values():
+            if node.relaxed:
+                for arc in node.arcs:
+                    if not arc.parent.relaxed:
+                        arc.parent.cutset = True
+                        arc.parent.above_cutset = True
+
+    def marked_cutset(self):
+        return [node for node in self.nodes.values() if node.cutset]
     
     def filter_with_local_bounds(self):
         if not self.input.settings.use_locb:
@@ -251,14 +397,40 @@ class Layer:
             if node.cutset and node.value_top + node.value_bot <= self.input.best:
                 node.theta = self.input.best - node.value_bot
                 node.deleted_by_local_bounds = True
-                node.deleted_by_hint = self.input.best
-                self.deleted_by_local_bounds.append(node)
-                del self.nodes[node.state]
+                self.delete(node, "local_bounds", self.input.best)
                 used = True
         return used
 
     def width(self):
         return len(self.nodes)
+
+    def copy(self):
+        # the nodes are shared
+        layer = Layer(self.input, self.depth)
+        layer.nodes = dict(self.nodes)
+        for reason in DELETION_REASONS:
+            setattr(layer, "deleted_by_" + reason, list(getattr(self, "deleted_by_" + reason)))
+        layer.deleted_counts = dict(self.deleted_counts)
+        return layer
+
+    def detach(self):
+        # forget the arcs so that the layers above can be released, the best arcs are moved to a
+        # PathTrail, they point to the rows of the trail of the previous layer once it is detached
+        trail = PathTrail(array('q'), array('q'), dict(), None)
+        for row, node in enumerate(self.nodes.values()):
+            arc = node.best_arc
+            if arc is None or arc.parent.trail is None:
+                trail.best_parent.append(-1)
+                trail.best_decision.append(0)
+                trail.paths[row] = path_of(node)
+            else:
+                trail.best_parent.append(arc.parent.row)
+                trail.best_decision.append(arc.decision)
+                trail.up = arc.parent.trail
+            node.trail = trail
+            node.row = row
+            node.arcs = []
+            node.best_arc = None
     
     def local_bounds(self):
         for node in self.nodes.values():
@@ -269,14 +441,14 @@ class Layer:
         for nodes in [self.deleted_by_dominance, self.deleted_by_cache, self.deleted_by_rub, self.deleted_by_local_bounds]:
             for node in nodes:
                 if (self.input.settings.cutset == Cutset.FRONTIER or (self.input.settings.cutset == Cutset.LAYER and node.depth <= lel)) and not node.relaxed:
-                    self.input.cache[node.state] = Threshold(node.theta, node.value_top, True)
+                    self.input.cache[node.key] = Threshold(node.theta, node.value_top, True)
                 for arc in node.arcs:
                     arc.parent.theta = min(arc.parent.theta, node.theta - arc.reward)
         for node in self.nodes.values():
             if node.cutset:
                 node.theta = min(node.theta, node.value_top)
             if node.above_cutset:
-                self.input.cache[node.state] = Threshold(node.theta, node.value_top)
+                self.input.cache[node.key] = Threshold(node.theta, node.value_top)
             for arc in node.arcs:
                 arc.parent.theta = min(arc.parent.theta, node.theta - arc.reward)
     
@@ -310,13 +482,594 @@ class Layer:
         ret += ">"
         return ret
     
+def number(x): # values are stored as doubles, give back ints when possible
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    return x
+
+class ArcView:
+    __slots__ = ["layer", "index"]
+
+    def __init__(self, layer, index):
+        self.layer = layer
+        self.index = index
+
+    @property
+    def parent(self):
+        return self.layer.prev.view(self.layer.arc_parent[self.index])
+
+    @property
+    def reward(self):
+        return number(self.layer.arc_reward[self.index])
+
+    @property
+    def decision(self):
+        return self.layer.arc_decision[self.index]
+
+    @property
+    def opt(self):
+        return self.layer.arc_opt[self.index] == 1
+
+class NodeView:
+    __slots__ = ["layer", "row"]
+    trail = None # the views of a released layer already read its PathTrail
+
+    def __init__(self, layer, row):
+        self.layer = layer
+        self.row = row
+
+    @property
+    def state(self):
+        return self.layer.states[self.row]
+
+    @property
+    def depth(self):
+        return self.layer.depth
+
+    @property
+    def value_top(self):
+        return number(self.layer.value_top[self.row])
+
+    @property
+    def value_bot(self):
+        return number(self.layer.value_bot[self.row])
+
+    @value_bot.setter
+    def value_bot(self, value):
+        self.layer.value_bot[self.row] = value
+
+    @property
+    def theta(self):
+        return number(self.layer.theta[self.row])
+
+    @theta.setter
+    def theta(self, value):
+        self.layer.theta[self.row] = value
+
+    @property
+    def rub(self):
+        return number(self.layer.rub[self.row])
+
+    @property
+    def ub(self):
+        return number(self.layer.ub[self.row])
+
+    @ub.setter
+    def ub(self, value):
+        self.layer.ub[self.row] = value
+
+    @property
+    def arcs(self):
+        return [ArcView(self.layer, i) for i in self.layer.arcs_of(self.row)]
+
+    def flag(self, flag):
+        return self.layer.flags[self.row] & flag != 0
+
+    def set_flag(self, flag, value):
+        if value:
+            self.layer.flags[self.row] |= flag
+        else:
+            self.layer.flags[self.row] &= ~flag
+
+    relaxed = property(lambda self: self.flag(RELAXED))
+    merged = property(lambda self: self.flag(MERGED))
+    cutset = property(lambda self: self.flag(CUTSET), lambda self, value: self.set_flag(CUTSET, value))
+    above_cutset = property(lambda self: self.flag(ABOVE_CUTSET), lambda self, value: self.set_flag(ABOVE_CUTSET, value))
+    deleted_by_rub = property(lambda self: self.flag(DELETED_BY_RUB))
+    deleted_by_local_bounds = property(lambda self: self.flag(DELETED_BY_LOCAL_BOUNDS))
+    deleted_by_cache = property(lambda self: self.flag(DELETED_BY_CACHE))
+    deleted_by_dominance = property(lambda self: self.flag(DELETED_BY_DOMINANCE))
+
+    @property
+    def deleted_by_hint(self):
+        return self.layer.hints.get(self.row)
+
+    @property
+    def best_arc(self):
+        parent = self.layer.best_parent[self.row]
+        if parent < 0:
+            return None
+        return Arc(self.layer.up.view(parent), None, self.layer.best_decision[self.row])
+
+    @property
+    def path(self):
+        return self.layer.paths.get(self.row)
+
+    @path.setter
+    def path(self, value):
+        self.layer.paths[self.row] = value
+
+    __lt__ = Node.__lt__
+    __str__ = Node.__str__
+
+class ArrayLayer:
+    # same interface as Layer, but nodes are rows of parallel arrays and arcs are
+    # stored in CSR format (sorted by child, arc_start[row] gives the first arc of row)
+    __slots__ = ["input", "depth", "prev", "rows", "states", "keys", "value_top", "value_bot", "theta", "rub", "ub", "flags", "hints",
+        "arc_child", "arc_parent", "arc_reward", "arc_decision", "arc_opt", "arc_start", "deleted_rows", "deleted_counts", "root", "written_back",
+        "best_parent", "best_decision", "paths", "up"]
+
+    def __init__(self, input, depth, root=None, prev=None):
+        self.input = input
+        self.depth = depth
+        self.prev = prev
+
+        self.rows = dict()
+        self.states = []
+        self.keys = []
+        self.value_top = array('d')
+        self.value_bot = array('d')
+        self.theta = array('d')
+        self.rub = array('d')
+        self.ub = array('d')
+        self.flags = array('B')
+        self.hints = dict()
+
+        self.arc_child = array('q')
+        self.arc_parent = array('q')
+        self.arc_reward = array('d')
+        self.arc_decision = array('q')
+        self.arc_opt = array('B')
+        self.arc_start = None
+
+        self.deleted_rows = {reason: array('q') for reason in DELETION_REASONS}
+        self.deleted_counts = dict.fromkeys(DELETION_REASONS, 0)
+
+        # parent row and decision of the first arc that gives value_top, as Node.best_arc, the
+        # parent rows are in up, the previous layer or its PathTrail once it is released
+        self.best_parent = array('q')
+        self.best_decision = array('q')
+        self.paths = dict() # memoized by path_of()
+        self.up = prev
+
+        # the root node object is shared with the solver, it is updated by write_back()
+        self.root = root
+        self.written_back = False
+        if root is not None:
+            root.key = state_key(input.model, root.state)
+            row = self.add(root.state, root.key, root.value_top, (RELAXED if root.relaxed else 0) | (MERGED if root.merged else 0))
+            self.ub[row] = root.ub
+            self.rows[root.key] = row
+            self.paths[row] = root.path
+
+    @property
+    def nodes(self):
+        return {key: self.view(row) for key, row in self.rows.items()}
+
+    deleted_by_dominance = property(lambda self: self.views(self.deleted_rows["dominance"]))
+    deleted_by_cache = property(lambda self: self.views(self.deleted_rows["cache"]))
+    deleted_by_rub = property(lambda self: self.views(self.deleted_rows["rub"]))
+    deleted_by_shrink = property(lambda self: self.views(self.deleted_rows["shrink"]))
+    deleted_by_local_bounds = property(lambda self: self.views(self.deleted_rows["local_bounds"]))
+
+    def views(self, rows):
+        return [self.view(row) for row in rows]
+
+    def view(self, row):
+        if self.written_back and row == 0:
+            return self.root
+        return NodeView(self, row)
+
+    def write_back(self):
+        if self.root is None:
+            return
+        self.root.value_bot = number(self.value_bot[0])
+        self.root.theta = number(self.theta[0])
+        self.root.rub = number(self.rub[0])
+        self.root.ub = number(self.ub[0])
+        self.root.cutset = self.flags[0] & CUTSET != 0
+        self.root.above_cutset = self.flags[0] & ABOVE_CUTSET != 0
+        self.written_back = True
+
+    def add(self, state, key, value_top, flags, parent=-1, decision=0):
+        self.states.append(state)
+        self.keys.append(key)
+        self.value_top.append(value_top)
+        self.value_bot.append(-math.inf)
+        self.theta.append(math.inf)
+        self.rub.append(math.inf)
+        self.ub.append(math.inf)
+        self.flags.append(flags)
+        self.best_parent.append(parent)
+        self.best_decision.append(decision)
+        return len(self.states) - 1
+
+    def add_arc(self, child, parent, reward, decision):
+        self.arc_child.append(child)
+        self.arc_parent.append(parent)
+        self.arc_reward.append(reward)
+        self.arc_decision.append(decision)
+        self.arc_opt.append(0)
+        self.arc_start = None
+
+    def arcs_of(self, row):
+        if self.arc_start is None:
+            self.sort_arcs()
+        return range(self.arc_start[row], self.arc_start[row + 1])
+
+    def sort_arcs(self):
+        # stable sort of the arcs by child, arc_start is built by counting the arcs of each child
+        order = sorted(range(len(self.arc_child)), key=self.arc_child.__getitem__)
+        for name in ["arc_child", "arc_parent", "arc_reward", "arc_decision", "arc_opt"]:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, map(column.__getitem__, order)))
+        start = array('q', bytes(8 * (len(self.states) + 1)))
+        for child in self.arc_child:
+            start[child + 1] += 1
+        for row in range(len(self.states)):
+            start[row + 1] += start[row]
+        self.arc_start = start
+
+    def delete(self, row, reason, hint=None):
+        self.deleted_counts[reason] += 1
+        if retains_deleted(self.input.settings, reason):
+            self.deleted_rows[reason].append(row)
+            if hint is not None:
+                self.hints[row] = hint
+        del self.rows[self.keys[row]]
+
+    def next(self):
+        next = ArrayLayer(self.input, self.depth + 1, prev=self)
+        model = self.input.model
+        if hasattr(model, "successors_batch"):
+            rows = list(self.rows.values())
+            (parents, decisions, rewards, states) = model.successors_batch([self.states[row] for row in rows], self.depth)
+            keys = state_keys(model, states)
+            # same as calling insert() for each transition, but the columns are built at once
+            parents = array('q', map(rows.__getitem__, parents))
+            children = array('q')
+            value_tops = []
+            flags = []
+            best_parents = []
+            best_decisions = []
+            for i in range(len(states)):
+                parent = parents[i]
+                value_top = self.value_top[parent] + rewards[i]
+                row = next.rows.get(keys[i])
+                if row is None:
+                    row = len(value_tops)
+                    next.rows[keys[i]] = row
+                    next.states.append(states[i])
+                    next.keys.append(keys[i])
+                    value_tops.append(value_top)
+                    flags.append(self.flags[parent] & RELAXED)
+                    best_parents.append(parent)
+                    best_decisions.append(decisions[i])
+                else:
+                    if value_top > value_tops[row]:
+                        value_tops[row] = value_top
+                        best_parents[row] = parent
+                        best_decisions[row] = decisions[i]
+                    flags[row] |= self.flags[parent] & RELAXED
+                children.append(row)
+            width = len(value_tops)
+            next.value_top = array('d', value_tops)
+            next.value_bot = array('d', [-math.inf]) * width
+            next.theta = array('d', [math.inf]) * width
+            next.rub = array('d', [math.inf]) * width
+            next.ub = array('d', [math.inf]) * width
+            next.flags = array('B', flags)
+            next.best_parent = array('q', best_parents)
+            next.best_decision = array('q', best_decisions)
+            next.arc_child = children
+            next.arc_parent = parents
+            next.arc_reward = array('d', rewards)
+            next.arc_decision = array('q', decisions)
+            next.arc_opt = array('B', bytes(len(children)))
+            return next
+        for row in self.rows.values():
+            state = self.states[row]
+            value_top = self.value_top[row]
+            relaxed = self.flags[row] & RELAXED
+            for decision in model.domain(state, self.depth):
+                successor = model.successor(state, decision)
+                if successor is None:
+                    continue
+                reward = model.reward(state, decision)
+                next.insert(successor, state_key(model, successor), value_top + reward, relaxed, row, reward, decision)
+        return next
+
+    def insert(self, state, key, value_top, relaxed, parent, reward, decision):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.add(state, key, value_top, relaxed, parent, decision)
+            self.rows[key] = row
+        else:
+            if value_top > self.value_top[row]:
+                self.value_top[row] = value_top
+                self.best_parent[row] = parent
+                self.best_decision[row] = decision
+            self.flags[row] |= relaxed
+        self.add_arc(row, parent, reward, decision)
+
+    def shrink(self):
+        (best, rest) = self.select(self.input.width)
+        if self.input.relaxed:
+            self.relax(best, rest)
+        else:
+            self.restrict(rest)
+
+    def select(self, k):
+        ranking = self.input.settings.ranking
+        if ranking is rank_by_value_top:
+            key = self.value_top.__getitem__
+        else:
+            key = lambda row: ranking(self.view(row))
+        best = heapq.nlargest(k, self.rows.values(), key=key)
+        kept = set(best)
+        return (best, [row for row in self.rows.values() if row not in kept])
+
+    def restrict(self, rest):
+        for row in rest:
+            self.delete(row, "shrink")
+
+    def relax(self, best, rest):
+        pivot = best[-1]
+        self.relax_helper([pivot] + rest, self.states[pivot].clone(), RELAXED | MERGED)
+
+    def finalize(self):
+        if self.width() > 0:
+            rows = list(self.rows.values())
+            self.relax_helper(rows, self.states[rows[0]].clone(), 0)
+            if self.input.settings.headless:
+                return
+
+            layer = self
+            row = next(iter(self.rows.values()))
+            while len(layer.arcs_of(row)) > 0:
+                for arc in layer.arcs_of(row):
+                    parent = layer.arc_parent[arc]
+                    if layer.prev.value_top[parent] + layer.arc_reward[arc] == layer.value_top[row]:
+                        layer.arc_opt[arc] = 1
+                        layer = layer.prev
+                        row = parent
+                        break
+
+    def relax_helper(self, to_merge, state, flags):
+        value_top = 0
+        best = None
+        arcs = []
+        for row in to_merge:
+            self.input.model.merge(state, self.states[row])
+            if best is None or self.value_top[row] > value_top:
+                best = row
+            value_top = max(value_top, self.value_top[row])
+            arcs.extend(self.arcs_of(row))
+            flags |= self.flags[row] & RELAXED
+            self.delete(row, "shrink")
+        (parent, decision) = (self.best_parent[best], self.best_decision[best])
+
+        # same semantics as Layer.insert for the merged node
+        key = state_key(self.input.model, state)
+        row = self.rows.get(key)
+        if row is None:
+            row = self.add(state, key, value_top, flags, parent, decision)
+            self.rows[key] = row
+        else:
+            if value_top > self.value_top[row]:
+                self.value_top[row] = value_top
+                self.best_parent[row] = parent
+                self.best_decision[row] = decision
+            self.flags[row] |= flags & RELAXED
+            arcs = arcs[:1]
+        for arc in arcs:
+            self.add_arc(row, self.arc_parent[arc], self.arc_reward[arc], self.arc_decision[arc])
+
+    def filter_with_dominance(self):
+        if not self.input.settings.use_dominance:
+            return False
+        if self.input.dominance_rule is None:
+            return False
+        rule = self.input.dominance_rule
+        used = False
+        order = sorted(self.rows.values(), key=lambda row: (rule.value(self.states[row]), self.value_top[row]), reverse=True)
+        groups = dict()
+        for row in order:
+            if not self.flags[row] & RELAXED:
+                groups.setdefault(rule.key(self.states[row]), []).append(row)
+
+        for key, rows in groups.items():
+            store = self.input.dominance.get(key)
+            if store is None:
+                store = dominance_store(rule, self.input.settings)
+                self.input.dominance[key] = store
+
+            handles = self.views(rows) if self.input.settings.dominance_handles and not self.input.settings.headless else None
+            results = store.add_all([self.states[row] for row in rows], [number(self.value_top[row]) for row in rows], handles)
+            for row, dominated in zip(rows, results):
+                if dominated is not None:
+                    self.theta[row] = dominated[1]
+                    self.flags[row] |= DELETED_BY_DOMINANCE
+                    self.delete(row, "dominance", dominated[0])
+                    used = True
+        return used
+
+    def filter_with_cache(self):
+        if not self.input.settings.use_cache:
+            return (False, False, False)
+        used = False
+        used_larger = False
+        used_pruning = False
+        for key, row in list(self.rows.items()):
+            threshold = self.input.cache.get(key)
+            if threshold is not None and self.value_top[row] <= threshold.theta:
+                self.theta[row] = threshold.theta
+                self.flags[row] |= DELETED_BY_CACHE
+                self.delete(row, "cache", threshold.theta)
+                self.input.cache.pruned(key)
+                used = True
+                used_larger |= self.value_top[row] > threshold.value_top
+                used_pruning |= threshold.pruning
+        return (used, used_larger, used_pruning)
+
+    def filter_with_rub(self):
+        if not self.input.settings.use_rub:
+            return False
+        used = False
+        best = self.input.best
+        rows = list(self.rows.values())
+        rubs = rough_upper_bounds(self.input, [self.states[row] for row in rows], [self.keys[row] for row in rows], self.depth)
+        for row, rub in zip(rows, rubs):
+            self.rub[row] = rub
+            if self.value_top[row] + rub <= best:
+                self.theta[row] = best - rub
+                self.flags[row] |= DELETED_BY_RUB
+                self.delete(row, "rub", best)
+                used = True
+        return used
+
+    def frontier(self, cutset_nodes):
+        prev = self.prev
+        for row in self.rows.values():
+            flags = self.flags[row]
+            if flags & CUTSET:
+                cutset_nodes.append(self.view(row))
+            for arc in self.arcs_of(row):
+                parent = self.arc_parent[arc]
+                if flags & RELAXED and not prev.flags[parent] & RELAXED:
+                    prev.flags[parent] |= CUTSET | ABOVE_CUTSET
+                prev.flags[parent] |= flags & ABOVE_CUTSET
+
+    def mark_frontier(self):
+        prev = self.prev
+        for row in self.rows.values():
+            if self.flags[row] & RELAXED:
+                for arc in self.arcs_of(row):
+                    parent = self.arc_parent[arc]
+                    if not prev.flags[parent] & RELAXED:
+                        prev.flags[parent] |= CUTSET | ABOVE_CUTSET
+
+    def marked_cutset(self):
+        return [self.view(row) for row in self.rows.values() if self.flags[row] & CUTSET]
+
+    def filter_with_local_bounds(self):
+        if not self.input.settings.use_locb:
+            return False
+        used = False
+        best = self.input.best
+        for row in list(self.rows.values()):
+            if self.flags[row] & CUTSET and self.value_top[row] + self.value_bot[row] <= best:
+                self.theta[row] = best - self.value_bot[row]
+                self.flags[row] |= DELETED_BY_LOCAL_BOUNDS
+                self.delete(row, "local_bounds", best)
+                used = True
+        return used
+
+    def width(self):
+        return len(self.rows)
+
+    def copy(self):
+        # the columns are copied since both layers keep changing, the states are shared
+        layer = ArrayLayer.__new__(ArrayLayer)
+        for name in ArrayLayer.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, (array, list)):
+                value = value[:]
+            elif isinstance(value, dict):
+                value = dict(value)
+            setattr(layer, name, value)
+        layer.deleted_rows = {reason: rows[:] for reason, rows in self.deleted_rows.items()}
+        return layer
+
+    def detach(self):
+        # the previous layer can be released, only what path_of() needs of it is kept
+        if self.prev is not None:
+            prev = self.prev
+            self.up = PathTrail(prev.best_parent, prev.best_decision, prev.paths, prev.up)
+        self.prev = None
+        for name in ["arc_child", "arc_parent", "arc_reward", "arc_decision", "arc_opt"]:
+            setattr(self, name, array(getattr(self, name).typecode))
+        self.arc_start = None
+
+    def local_bounds(self):
+        prev = self.prev
+        alive = self.mask(self.rows.values())
+        for arc, row in enumerate(self.arc_child):
+            if alive[row]:
+                parent = self.arc_parent[arc]
+                prev.value_bot[parent] = max(prev.value_bot[parent], self.value_bot[row] + self.arc_reward[arc])
+
+    def thresholds(self, lel):
+        cutset = self.input.settings.cutset
+        rows = list(self.rows.values())
+        for reason in ["dominance", "cache", "rub", "local_bounds"]:
+            for row in self.deleted_rows[reason]:
+                if (cutset == Cutset.FRONTIER or (cutset == Cutset.LAYER and self.depth <= lel)) and not self.flags[row] & RELAXED:
+                    self.input.cache[self.keys[row]] = Threshold(number(self.theta[row]), number(self.value_top[row]), True)
+            rows.extend(self.deleted_rows[reason])
+        for row in self.rows.values():
+            if self.flags[row] & CUTSET:
+                self.theta[row] = min(self.theta[row], self.value_top[row])
+            if self.flags[row] & ABOVE_CUTSET:
+                self.input.cache[self.keys[row]] = Threshold(number(self.theta[row]), number(self.value_top[row]))
+
+        # the thresholds are passed to the parents in one pass over the arcs
+        prev = self.prev
+        passed = self.mask(rows)
+        for arc, row in enumerate(self.arc_child):
+            if passed[row]:
+                parent = self.arc_parent[arc]
+                prev.theta[parent] = min(prev.theta[parent], self.theta[row] - self.arc_reward[arc])
+
+    def mask(self, rows):
+        mask = bytearray(len(self.states))
+        for row in rows:
+            mask[row] = 1
+        return mask
+
+    __str__ = Layer.__str__
+
+class PathTrail:
+    # what path_of() needs of a released layer, 16 bytes per row
+    __slots__ = ["best_parent", "best_decision", "paths", "up"]
+
+    def __init__(self, best_parent, best_decision, paths, up):
+        self.best_parent = best_parent
+        self.best_decision = best_decision
+        self.paths = paths
+        self.up = up
+
+    def view(self, row):
+        return NodeView(self, row)
+
+NODE_BYTES = 500 # traced bytes per node of a wide knapsack diagram, about 300 with Settings.compact
+
 class Diagram:
-    def __init__(self, input):
+    def __init__(self, input, prefix=None):
         self.input = input
-        self.layers = [Layer(input, input.root.depth, input.root)]
+        if prefix is not None:
+            self.layers = prefix[0] + [prefix[1]]
+        elif input.settings.compact:
+            self.layers = [ArrayLayer(input, input.root.depth, input.root)]
+        else:
+            self.layers = [Layer(input, input.root.depth, input.root)]
         self.lel = input.root.depth
         self.relaxed = input.relaxed
         self.cutset_nodes = []
+        self.released = [] # (depth, width, deleted_counts) of the layers released by a headless compilation
+        self.frontier_layers = None # cutset nodes collected while compiling, by layer
+        self.prefix = None # exact layers and first overfull layer of a headless restricted diagram, see warm_start()
+        self.profile = Profile() if input.settings.profile else None
 
         self.used_dominance = False
         self.used_cache = False
@@ -325,42 +1078,128 @@ class Diagram:
         self.used_rub = False
         self.used_locb = False
 
-        self.compile()
+        self.compile(prefix)
         
-    def compile(self):
+    def compile(self, prefix=None):
         depth = self.layers[-1].depth
+        if prefix is not None:
+            depth = self.warm_start(prefix)
         while depth < self.input.model.nb_variables():
-            self.layers.append(self.layers[-1].next())
+            self.layers.append(self.run(self.layers[-1].next))
 
             if depth + 1 < self.input.model.nb_variables():
-                (used_cache, used_cache_larger, used_cache_pruning) = self.layers[-1].filter_with_cache()
-                self.used_cache |= used_cache
-                self.used_cache_larger |= used_cache_larger
-                self.used_cache_pruning |= used_cache_pruning
-                self.used_dominance |= self.layers[-1].filter_with_dominance()
-                self.used_rub |= self.layers[-1].filter_with_rub()
-
-            if depth > self.input.root.depth and depth + 1 < self.input.model.nb_variables() and self.layers[-1].width() > self.input.settings.width:
-                self.layers[-1].shrink()
-            elif self.lel == depth:
-                self.lel = depth + 1
+                for name in self.input.settings.filters:
+                    self.filter(name)
 
-            depth += 1
-        self.layers[-1].finalize()
+            depth = self.reduce(depth)
+            if self.input.interrupt is not None:
+                limit = self.input.interrupt(self)
+                if limit is not None:
+                    raise Interrupted(limit)
+        self.run(self.layers[-1].finalize)
+        if self.releases_layers():
+            self.release()
 
         if self.input.relaxed or self.is_exact():
-            self.cutset()
-            self.local_bounds()
-            self.thresholds()
+            self.run(self.cutset)
+            self.run(self.local_bounds)
+            self.run(self.thresholds)
+
+        if self.input.settings.compact:
+            self.layers[0].write_back()
+
+    def filter(self, name):
+        used = self.run(getattr(self.layers[-1], "filter_with_" + name))
+        if name == "cache":
+            (used, used_larger, used_pruning) = used
+            self.used_cache_larger |= used_larger
+            self.used_cache_pruning |= used_pruning
+        setattr(self, "used_" + name, getattr(self, "used_" + name) | used)
+
+    def reduce(self, depth):
+        # shrinks the new last layer if it is too wide, returns its depth
+        if depth > self.input.root.depth and depth + 1 < self.input.model.nb_variables() and self.layers[-1].width() > self.input.width:
+            if self.prefix is None and self.input.settings.headless and not self.input.relaxed and not self.input.root.relaxed:
+                self.prefix = (self.layers[:-1], self.layers[-1].copy(), list(self.released),
+                    (self.used_dominance, self.used_cache, self.used_cache_larger, self.used_cache_pruning, self.used_rub))
+            self.run(self.layers[-1].shrink)
+        elif self.lel == depth:
+            self.lel = depth + 1
+
+        depth += 1
+        if depth < self.input.model.nb_variables() and self.releases_layers():
+            self.release()
+        return depth
+
+    def warm_start(self, prefix):
+        # the relaxed diagram of the same root is identical to the restricted one until its first
+        # overfull layer, so it resumes from there with the layers of the restricted diagram
+        (_, overfull, released, used) = prefix
+        self.released = list(released)
+        (self.used_dominance, self.used_cache, self.used_cache_larger, self.used_cache_pruning, self.used_rub) = used
+        self.lel = overfull.depth - 1
+        if self.input.settings.compact:
+            self.layers[0].written_back = False
+        return self.reduce(overfull.depth - 1)
+
+    def run(self, method):
+        # calls a method of a layer or of the diagram, timed with the number of nodes before and after when profiling
+        if self.profile is None:
+            return method()
+        target = method.__self__
+        nodes_in = target.width()
+        start = time.perf_counter()
+        ret = method()
+        nodes_out = (ret if method.__name__ == "next" else target).width()
+        self.profile.record(method.__name__, None if target is self else target.depth, start, nodes_in, nodes_out)
+        return ret
+
+    def width(self):
+        return sum(layer.width() for layer in self.layers)
+
+    def memory(self):
+        # rough estimate from the nodes of the layers still held
+        return self.width() * NODE_BYTES
+
+    def releases_layers(self):
+        settings = self.input.settings
+        if not settings.headless:
+            return False
+        if not settings.use_locb and not settings.use_cache:
+            return True # the backward pass only needs the cutset, which is collected while compiling
+        return not self.input.relaxed and self.lel < self.layers[-1].depth # an inexact restricted diagram only gives a best value
+
+    def release(self):
+        # called once the last layer is complete, only the root, the last exact layer and the last two layers are kept
+        if self.input.relaxed and self.input.settings.cutset == Cutset.FRONTIER and len(self.layers) > 1:
+            if self.frontier_layers is None:
+                self.frontier_layers = []
+            self.layers[-1].mark_frontier()
+            self.frontier_layers.append(self.layers[-2].marked_cutset())
+        if len(self.layers) > 2:
+            if self.prefix is None or self.layers[-2].depth > self.prefix[1].depth: # the prefix is still needed by the relaxed diagram
+                self.layers[-2].detach()
+            kept = [self.layers[0]]
+            for layer in self.layers[1:-2]:
+                if layer.depth == self.lel:
+                    kept.append(layer)
+                else:
+                    self.released.append((layer.depth, layer.width(), layer.deleted_counts))
+            self.layers[:-2] = kept
 
     def cutset(self):
         if self.input.settings.cutset == Cutset.LAYER or self.is_exact():
-            for node in self.layers[self.lel - self.input.root.depth].nodes.values():
-                node.cutset = True
-                self.cutset_nodes.append(node)
-            for layer in self.layers[(self.lel - self.input.root.depth)::-1]:
-                for node in layer.nodes.values():
-                    node.above_cutset = True
+            for layer in reversed(self.layers):
+                if layer.depth == self.lel:
+                    for node in layer.nodes.values():
+                        node.cutset = True
+                        self.cutset_nodes.append(node)
+                if layer.depth <= self.lel:
+                    for node in layer.nodes.values():
+                        node.above_cutset = True
+        elif self.frontier_layers is not None:
+            for nodes in reversed(self.frontier_layers):
+                self.cutset_nodes.extend(nodes)
         elif self.input.settings.cutset == Cutset.FRONTIER:
             for layer in reversed(self.layers):
                 layer.frontier(self.cutset_nodes)
@@ -400,11 +1239,20 @@ class Diagram:
             return None
         return terminal.value_top
 
+    def get_best_path(self):
+        terminal = self.get_terminal()
+        if terminal is None:
+            return None
+        return path_of(terminal)
+
     def get_cutset(self):
         return self.cutset_nodes
     
     def is_exact(self):
         return self.lel == self.input.model.nb_variables()
+
+    def summary(self):
+        return Summary(self)
     
     def __str__(self):
         ret = "diagram<" + ("exact" if self.is_exact() else ("relaxed" if self.relaxed else "restricted")) +  ",lel=" + str(self.lel) + ",layers=<\n"
@@ -413,8 +1261,403 @@ class Diagram:
         ret += ">>"
         return ret
     
+class Summary:
+    # what remains of a diagram once its layers are released
+    def __init__(self, dd):
+        self.relaxed = dd.relaxed
+        self.exact = dd.is_exact()
+        self.lel = dd.lel
+        self.root_depth = dd.input.root.depth
+        self.best_value = dd.get_best_value()
+        self.cutset_size = len(dd.get_cutset())
+
+        self.used_dominance = dd.used_dominance
+        self.used_cache = dd.used_cache
+        self.used_cache_larger = dd.used_cache_larger
+        self.used_cache_pruning = dd.used_cache_pruning
+        self.used_rub = dd.used_rub
+        self.used_locb = dd.used_locb
+
+        layers = sorted(dd.released + [(layer.depth, layer.width(), layer.deleted_counts) for layer in dd.layers], key=lambda layer: layer[0])
+        self.widths = [width for (_, width, _) in layers]
+        self.deleted = dict()
+        for name in DELETION_REASONS:
+            self.deleted[name] = sum(counts[name] for (_, _, counts) in layers)
+
+    def is_exact(self):
+        return self.exact
+
+    def get_best_value(self):
+        return self.best_value
+
+    def nodes(self):
+        return sum(self.widths) + sum(self.deleted.values())
+
+    def __str__(self):
+        return "summary<" + ("exact" if self.exact else ("relaxed" if self.relaxed else "restricted")) + ",lel=" + str(self.lel) \
+            + ",widths=" + str(self.widths) + ",deleted=" + str(self.deleted) + ">"
+
+class Profile:
+    # time and nodes in and out of each compilation phase, per layer for a diagram and
+    # in total for a solver, phases are named by their stack such as "relaxed;next"
+    def __init__(self):
+        self.records = [] # (phase, depth, seconds, nodes_in, nodes_out)
+        self.totals = dict() # phase -> [calls, seconds, nodes_in, nodes_out]
+
+    def record(self, phase, depth, start, nodes_in, nodes_out):
+        seconds = time.perf_counter() - start
+        self.records.append((phase, depth, seconds, nodes_in, nodes_out))
+        self.add_total(phase, 1, seconds, nodes_in, nodes_out)
+
+    def add_total(self, phase, calls, seconds, nodes_in, nodes_out):
+        total = self.totals.get(phase)
+        if total is None:
+            self.totals[phase] = [calls, seconds, nodes_in, nodes_out]
+        else:
+            total[0] += calls
+            total[1] += seconds
+            total[2] += nodes_in
+            total[3] += nodes_out
+
+    def add(self, other, prefix=None):
+        if other is None:
+            return
+        for phase, total in other.totals.items():
+            self.add_total(phase if prefix is None else prefix + ";" + phase, *total)
+
+    def to_json(self):
+        return {
+            "phases": {phase: dict(zip(["calls", "seconds", "nodes_in", "nodes_out"], total)) for phase, total in self.totals.items()},
+            "layers": [dict(zip(["phase", "depth", "seconds", "nodes_in", "nodes_out"], record)) for record in self.records],
+        }
+
+    def folded(self):
+        # collapsed stacks in microseconds, as read by flamegraph.pl or speedscope
+        return "".join("{} {}\n".format(phase, round(total[1] * 1e6)) for phase, total in self.totals.items())
+
 class Threshold:
+    __slots__ = ["theta", "value_top", "pruning"]
+
     def __init__(self, theta, value_top, pruning=False):
         self.theta = theta
         self.value_top = value_top
-        self.pruning = pruning
\ No newline at end of file
+        self.pruning = pruning
+
+def dominance_store(rule, settings):
+    handles = settings.dominance_handles and not settings.headless
+    if hasattr(rule, "is_ordered") and rule.is_ordered() and rule.use_value():
+        return ParetoFront(rule, handles, settings.dominance_max_size)
+    return DominanceList(rule, handles, settings.dominance_max_size)
+
+class DominanceList:
+    # non-dominated (state, value_top, handle) entries of a dominance key, compared one by one with the rule
+    def __init__(self, rule, handles=True, max_size=math.inf):
+        self.rule = rule
+        self.handles = handles
+        self.max_size = max_size
+        self.entries = []
+
+    def add_all(self, states, tops, handles):
+        # returns for each node (dominating handle, theta) if it is dominated, None if it was stored
+        results = [self.add(states[i], tops[i], handles[i] if self.handles else None) for i in range(len(states))]
+        if len(self.entries) > self.max_size:
+            del self.entries[:len(self.entries) - self.max_size]
+        return results
+
+    def add(self, state, value_top, handle):
+        others = self.entries
+        j = 0
+        while j < len(others):
+            (other_state, other_top, other_handle) = others[j]
+            cmp = self.rule.check(state, other_state)
+            if cmp == 0:
+                if self.rule.use_value():
+                    if value_top >= other_top:
+                        del others[j]
+                    else:
+                        return (other_handle, other_top - 1)
+                else:
+                    del others[j]
+            elif cmp > 0:
+                if self.rule.use_value():
+                    if value_top >= other_top:
+                        del others[j]
+                    else:
+                        j += 1
+                else:
+                    del others[j]
+            elif cmp < 0:
+                if self.rule.use_value():
+                    if value_top <= other_top:
+                        return (other_handle, other_top)
+                    else:
+                        j += 1
+                else:
+                    return (other_handle, math.inf)
+        others.append((state, value_top, handle))
+        return None
+
+    def __len__(self):
+        return len(self.entries)
+
+PARETO_MERGE_RATIO = 4 # batches of at least a quarter of the front are merged in one pass
+
+class ParetoFront:
+    # for rules where check(a, b) has the sign of value(a) - value(b), the non-dominated entries
+    # sorted by increasing value have strictly decreasing value_top, only these two columns
+    # are stored plus optional node handles for visualization
+    def __init__(self, rule, handles=True, max_size=math.inf):
+        self.rule = rule
+        self.values = array('d')
+        self.tops = array('d')
+        self.handles = [] if handles else None
+        self.max_size = max_size
+
+    def add_all(self, states, tops, handles):
+        # the batch is sorted by decreasing (value, value_top), a batch that is small compared to
+        # the front is inserted node by node with binary searches, a larger one is merged in one pass
+        values = [self.rule.value(state) for state in states]
+        if len(values) * PARETO_MERGE_RATIO < len(self.values):
+            results = [self.insert(values[i], tops[i], handles[i] if self.handles is not None else None) for i in range(len(values))]
+            if len(self.values) > self.max_size:
+                drop = len(self.values) - int(self.max_size)
+                del self.values[:drop]
+                del self.tops[:drop]
+                if self.handles is not None:
+                    del self.handles[:drop]
+            return results
+        return self.merge(values, tops, handles)
+
+    def insert(self, value, value_top, handle):
+        # the entry with the smallest value >= value has the largest value_top among those
+        i = bisect.bisect_left(self.values, value)
+        end = i
+        if i < len(self.values):
+            other_top = number(self.tops[i])
+            if self.values[i] == value:
+                if value_top < other_top:
+                    return (self.handle(i), other_top - 1)
+                end = i + 1
+            elif value_top <= other_top:
+                return (self.handle(i), other_top)
+
+        # entries with a smaller value and a value_top <= value_top are dominated by the new one
+        start = bisect.bisect_left(self.tops, - value_top, 0, i, key=operator.neg)
+        self.values[start:end] = array('d', [value])
+        self.tops[start:end] = array('d', [value_top])
+        if self.handles is not None:
+            self.handles[start:end] = [handle]
+        return None
+
+    def merge(self, values, tops, handles):
+        # merges the batch into the front walking both from the largest value, gives the same
+        # result as inserting the nodes one by one
+        out_values = []
+        out_tops = []
+        out_handles = []
+        results = []
+
+        # kept entry with the largest value_top among those with a larger value
+        best_top = -math.inf
+        best_value = None
+        best_handle = None
+
+        p = len(self.values) - 1
+        for i in range(len(values)):
+            value = values[i]
+            value_top = tops[i]
+
+            # old entries with a larger value survive if no kept entry dominates them
+            while p >= 0 and self.values[p] > value:
+                if self.tops[p] > best_top:
+                    (best_top, best_value, best_handle) = self.keep(self.values[p], self.tops[p], self.handle(p), out_values, out_tops, out_handles)
+                p -= 1
+
+            # an old entry with the same value is compared directly
+            if p >= 0 and self.values[p] == value:
+                if self.tops[p] > best_top:
+                    if value_top < self.tops[p]:
+                        (best_top, best_value, best_handle) = self.keep(self.values[p], self.tops[p], self.handle(p), out_values, out_tops, out_handles)
+                        p -= 1
+                        results.append((best_handle, number(best_top) - 1))
+                        continue
+                p -= 1
+
+            if best_value == value:
+                if value_top < best_top:
+                    results.append((best_handle, number(best_top) - 1))
+                    continue
+                out_values.pop()
+                out_tops.pop()
+                out_handles.pop()
+            elif value_top <= best_top:
+                results.append((best_handle, number(best_top)))
+                continue
+
+            handle = handles[i] if self.handles is not None else None
+            (best_top, best_value, best_handle) = self.keep(value, value_top, handle, out_values, out_tops, out_handles)
+            results.append(None)
+
+        while p >= 0:
+            if self.tops[p] > best_top:
+                (best_top, best_value, best_handle) = self.keep(self.values[p], self.tops[p], self.handle(p), out_values, out_tops, out_handles)
+            p -= 1
+
+        # the entries with the smallest values are dropped first when the front is too large,
+        # the out lists are sorted by decreasing value
+        keep = int(min(len(out_values), self.max_size))
+        self.values = array('d', reversed(out_values[:keep]))
+        self.tops = array('d', reversed(out_tops[:keep]))
+        if self.handles is not None:
+            self.handles = list(reversed(out_handles[:keep]))
+        return results
+
+    def keep(self, value, value_top, handle, out_values, out_tops, out_handles):
+        out_values.append(value)
+        out_tops.append(value_top)
+        out_handles.append(handle)
+        return (value_top, value, handle)
+
+    def handle(self, i):
+        if self.handles is None:
+            return None
+        return self.handles[i]
+
+    def __len__(self):
+        return len(self.values)
+
+class ThresholdCache:
+    # thresholds by state key (see state_keys), bounded by a number of entries and/or an approximate
+    # number of bytes: the size of an entry is estimated once, from the first one, so max_bytes is
+    # only as accurate as that entry is typical (packed int keys all have about the same size),
+    # forgetting a threshold only loses pruning so any entry can be evicted,
+    # depth gives the depth of a key for the eviction by depth, the solver sets it with key_depth()
+    # when it is not given
+    def __init__(self, max_entries=math.inf, max_bytes=math.inf, eviction=Eviction.LRU, depth=None):
+        self.entries = OrderedDict()
+        self.by_depth = dict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.depth = depth
+        self.capacity = max_entries
+        self.entry_bytes = None
+        self.journal = None # while it is a dict, also gets the thresholds that are set, see solve_subproblem()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        threshold = self.entries.get(key)
+        if threshold is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.eviction == Eviction.LRU:
+            self.entries.move_to_end(key)
+        return threshold
+
+    def pruned(self, key):
+        if self.eviction == Eviction.PRUNING and key in self.entries:
+            self.entries.move_to_end(key)
+
+    def __setitem__(self, key, threshold):
+        if self.journal is not None:
+            self.journal[key] = threshold
+        if key in self.entries:
+            self.entries[key] = threshold
+            if self.eviction == Eviction.LRU:
+                self.entries.move_to_end(key)
+            return
+
+        if self.entry_bytes is None:
+            self.entry_bytes = entry_size(key, threshold)
+            if self.max_bytes < math.inf:
+                self.capacity = min(self.max_entries, self.max_bytes // self.entry_bytes)
+
+        self.entries[key] = threshold
+        if self.eviction == Eviction.DEPTH:
+            if self.depth is None:
+                raise ValueError("Eviction.DEPTH needs the depth of the keys, give depth= or define model.depth_of()")
+            self.by_depth.setdefault(self.depth(key), dict())[key] = None
+        while len(self.entries) > self.capacity:
+            self.evict()
+
+    def evict(self):
+        if self.eviction == Eviction.DEPTH:
+            depth = min(self.by_depth)
+            keys = self.by_depth[depth]
+            key = next(iter(keys))
+            del keys[key]
+            if len(keys) == 0:
+                del self.by_depth[depth]
+            del self.entries[key]
+        else:
+            self.entries.popitem(last=False)
+        self.evictions += 1
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": len(self.entries) * (self.entry_bytes or 0),
+        }
+
+class BoundCache:
+    # rough upper bounds by state key, the least recently used ones are evicted beyond max_entries
+    def __init__(self, max_entries=math.inf):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        rub = self.entries.get(key)
+        if rub is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return rub
+
+    def __setitem__(self, key, rub):
+        self.entries[key] = rub
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+def entry_size(*objects): # rough estimate, objects and their attributes plus the dict slot
+    size = 3 * 8
+    for o in objects:
+        size += sys.getsizeof(o)
+        if hasattr(o, "__dict__"):
+            size += sys.getsizeof(o.__dict__)
+    return size
@@ -0,0 +1,70 @@
+from array import array
+
+from dd import *
+
+def transitions(model, states, depth):
+    # same result as model.successors_batch, also for models that only define successor()
+    if hasattr(model, "successors_batch"):
+        return model.successors_batch(states, depth)
+    parents = array('q')
+    decisions = []
+    rewards = []
+    successors = []
+    for parent, state in enumerate(states):
+        for decision in model.domain(state, depth):
+            successor = model.successor(state, decision)
+            if successor is None:
+                continue
+            parents.append(parent)
+            decisions.append(decision)
+            rewards.append(model.reward(state, decision))
+            successors.append(successor)
+    return (parents, decisions, rewards, successors)
+
+def solve_dp(model, root=None, backtrack=False):
+    # forward dynamic programming from root (a Node, the model root by default) that only keeps
+    # the best value of each state of a layer, i.e. an exact diagram without arcs, returns the best
+    # value and, with backtrack, the decisions of an optimal path from the root recovered from
+    # one parent pointer per state, the same path as the opt arcs of an exact Diagram
+    if root is None:
+        root = Node(model.root())
+    states = [root.state]
+    values = [root.value_top]
+    pointers = [] # (parent, decision) arrays of each layer below the root
+    for depth in range(root.depth, model.nb_variables()):
+        (parents, decisions, rewards, successors) = transitions(model, states, depth)
+        keys = state_keys(model, successors)
+        rows = dict()
+        states = []
+        next_values = []
+        parent = array('q')
+        decision = array('q')
+        for i in range(len(successors)):
+            value = values[parents[i]] + rewards[i]
+            row = rows.get(keys[i])
+            if row is None:
+                rows[keys[i]] = len(states)
+                states.append(successors[i])
+                next_values.append(value)
+                parent.append(parents[i])
+                decision.append(decisions[i])
+            elif value > next_values[row]:
+                next_values[row] = value
+                parent[row] = parents[i]
+                decision[row] = decisions[i]
+        values = next_values
+        if len(states) == 0:
+            return (None, None)
+        if backtrack:
+            pointers.append((parent, decision))
+
+    best = max(values)
+    if not backtrack:
+        return (best, None)
+    row = values.index(best)
+    path = []
+    for (parent, decision) in reversed(pointers):
+        path.append(decision[row])
+        row = parent[row]
+    path.reverse()
+    return (best, path)
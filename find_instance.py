@@ -1,93 +1,128 @@
+import argparse
+import multiprocessing
+import os
+import queue
 import random
+import time
 
 from knapsack import *
+from predicates import *
 from solver import *
 
-def main():
+width = 3
+cutset = Cutset.FRONTIER
 
-    width = 3
-    cutset = Cutset.FRONTIER
-
-    settings = [
-        [
-            Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
-            Settings(width, cutset, use_rub=False, use_locb=False, use_cache=True, use_dominance=False),
-        ],
-        [
-            Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
-            Settings(width, cutset, use_rub=True, use_locb=True, use_cache=True, use_dominance=False),
-        ],
-        [
-            Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
-            Settings(width, cutset, use_rub=True, use_locb=True, use_cache=True, use_dominance=True),
-        ]
+settings = [
+    [
+        Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
+        Settings(width, cutset, use_rub=False, use_locb=False, use_cache=True, use_dominance=False),
+    ],
+    [
+        Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
+        Settings(width, cutset, use_rub=True, use_locb=True, use_cache=True, use_dominance=False),
+    ],
+    [
+        Settings(width, cutset, use_rub=True, use_locb=True, use_cache=False, use_dominance=False),
+        Settings(width, cutset, use_rub=True, use_locb=True, use_cache=True, use_dominance=True),
     ]
+]
+
+def conditions(i, setting):
+    ret = ["len(dds) >= 4", "len(dds) <= 5" if i == 0 else "len(dds) <= 4"]
+    if setting[0].use_rub:
+        ret.append("dds[1].used_rub")
+    if setting[0].use_locb:
+        ret.append("dds[1].used_locb")
+    if any(s.use_cache for s in setting):
+        ret.append("any(dd.used_cache for dd in dds)")
+        if i < 2:
+            ret.append("dds[3].used_cache_larger") # pruning happens with larger value than the one used to compute the threshold
+        if i == 0:
+            ret.append("not dds[2].is_exact()") # first cutset dd is relaxed
+        if i == 1:
+            # with pruning enabled, first cutset dd is fully pruned
+            ret.append(DD(2, lambda dd: dd.get_best_value() is None if dd.is_exact() else len(dd.get_cutset()) == 0))
+            ret.append("dds[3].used_cache_pruning") # with pruning enabled, second cutset dd uses a pruning threshold
+    if any(s.use_dominance for s in setting):
+        ret.append("any(dd.used_dominance for dd in dds)")
+    return predicates(*ret)
+
+def check(instance):
+    # returns the dump of all dds if the instance qualifies, None otherwise
+    model = KnapsackModel(instance)
+    dominance_rule = KnapsackDominance()
+
+    all_dds = []
+    for i in range(len(settings)):
+        setting = settings[i]
+
+        solver = Solver(model, dominance_rule, None, keep_dds=True)
+        if not solver.solve(setting, [0], conditions(i, setting)):
+            return None
+
+        all_dds.append(solver.dds)
+
+    ret = str(instance) + "\n"
+    for dds in all_dds:
+        ret += "=========== dds for next config ===========\n"
+        for dd in dds:
+            ret += str(dd) + "\n"
+    return ret
+
+def worker_rand(seed, worker):
+    # the instances of a worker only depend on the base seed and the worker id
+    return random.Random("{}:{}".format(seed, worker))
+
+def search(seed, worker, n, hits, stop):
+    rand = worker_rand(seed, worker)
+    attempt = 0
+    while not stop.is_set():
+        dump = check(KnapsackInstance.random(n, rand))
+        if dump is not None:
+            hits.put((worker, attempt, dump))
+        attempt += 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Search random instances whose DDs show all the pruning mechanisms.")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--hits", type=int, default=1, help="stop after this many qualifying instances")
+    parser.add_argument("--time", type=float, default=math.inf, help="time budget in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-n", type=int, default=5, help="number of items")
+    parser.add_argument("--output", default="instances")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+
+    hits = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=search, args=(args.seed, worker, args.n, hits, stop), daemon=True) for worker in range(args.workers)]
+    for process in workers:
+        process.start()
+
+    start = time.time()
+    found = 0
+    while found < args.hits:
+        remaining = args.time - (time.time() - start)
+        if remaining <= 0:
+            break
+        try:
+            (worker, attempt, dump) = hits.get(timeout=min(remaining, 1))
+        except queue.Empty:
+            continue
+
+        # attempt-th instance generated by worker_rand(seed, worker)
+        file = os.path.join(args.output, "instance_{}_{}_{}.txt".format(args.seed, worker, attempt))
+        with open(file, "w") as fd:
+            fd.write(dump)
+        print(file, dump.split("\n")[0], flush=True)
+        found += 1
 
-    rand = random.Random(0)
-
-    while True:
-        found = True
-        instance = KnapsackInstance.random(5, rand)
-        all_dds = []
-
-        model = KnapsackModel(instance)
-        dominance_rule = KnapsackDominance()
-
-        for i in range(len(settings)):
-            setting = settings[i]
-
-            solver = Solver(model, dominance_rule, None)
-            solver.solve(setting, [0])
-
-            if len(solver.dds) < 4:
-                found = False
-                break
-            if i == 0 and len(solver.dds) > 5:
-                found = False
-                break
-            if i > 0 and len(solver.dds) > 4:
-                found = False
-                break
-            if setting[0].use_rub:
-                if not solver.dds[1].used_rub:
-                    found = False
-                    break
-            if setting[0].use_locb:
-                if not solver.dds[1].used_locb:
-                    found = False
-                    break
-            if any(s.use_cache for s in setting):
-                if not any(dd.used_cache for dd in solver.dds):
-                    found = False
-                    break
-                if i < 2 and not solver.dds[3].used_cache_larger: # pruning happens with larger value than the one used to compute the threshold
-                    found = False
-                    break
-                if i == 0 and solver.dds[2].is_exact(): # first cutset dd is relaxed
-                    found = False
-                    break
-                if i == 1 and solver.dds[2].is_exact() and solver.dds[2].get_best_value() is not None: # with pruning enabled, first cutset dd is fully pruned
-                    found = False
-                    break
-                if i == 1 and not solver.dds[2].is_exact() and len(solver.dds[2].get_cutset()) > 0: # with pruning enabled, first cutset dd is fully pruned
-                    found = False
-                    break
-                if i == 1 and not solver.dds[3].used_cache_pruning: # with pruning enabled, second cutset dd uses a pruning threshold
-                    found = False
-                    break
-            if any(s.use_dominance for s in setting):
-                if not any(dd.used_dominance for dd in solver.dds):
-                    found = False
-                    break
-
-            all_dds.append(solver.dds)
-            
-        if found:
-            print(instance)
-            for dds in all_dds:
-                print("=========== dds for next config ===========")
-                for dd in dds:
-                    print(dd)
+    stop.set()
+    for process in workers:
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
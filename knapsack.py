@@ -1,4 +1,6 @@
+import bisect
 import math
+from array import array
 
 USE_LP_BOUND = False
 
@@ -18,7 +20,22 @@ class KnapsackInstance:
     
     def __str__(self):
         return "instance<n=" + str(self.n) + ",c=" + str(self.c) + ",v=" + str(self.v) + ",w=" + str(self.w) + ",q=" + str(self.q) + ">"
-    
+
+    def check(self, decisions):
+        # value of the solution taking decisions[i] copies of item i, None if it is infeasible
+        if len(decisions) != self.n:
+            return None
+        weight = 0
+        value = 0
+        for i, x in enumerate(decisions):
+            if x < 0 or x > self.q[i]:
+                return None
+            weight += x * self.w[i]
+            value += x * self.v[i]
+        if weight > self.c:
+            return None
+        return value
+
     def random(n, rand):
         alpha = 6
         beta = 2
@@ -38,6 +55,8 @@ class KnapsackInstance:
         return KnapsackInstance(n, c, w, v, q)
 
 class KnapsackState:
+    __slots__ = ["capa", "depth"]
+
     def __init__(self, capa, depth):
         self.capa = capa
         self.depth = depth
@@ -48,11 +67,11 @@ class KnapsackState:
     def __lt__(self, other): # used only for tikz output
         return self.capa > other.capa
 
-    def __hash__(self):
-        return hash((self.capa, self.depth))
+    def __hash__(self): # packed into one int rather than hashing a tuple
+        return self.capa << 16 ^ self.depth
 
     def __eq__(self, other):
-        return (self.capa, self.depth) == (other.capa, other.depth)
+        return self.capa == other.capa and self.depth == other.depth
     
     def __str__(self):
         return "state<capa=" + str(self.capa) + ">"
@@ -60,6 +79,13 @@ class KnapsackState:
 class KnapsackModel:
     def __init__(self, instance):
         self.instance = instance
+
+        # prefix sums of the weights and values of all copies of the items, used by the bounds
+        self.weights = [0]
+        self.values = [0]
+        for i in range(instance.n):
+            self.weights.append(self.weights[-1] + instance.w[i] * instance.q[i])
+            self.values.append(self.values[-1] + instance.v[i] * instance.q[i])
     
     def nb_variables(self):
         return self.instance.n
@@ -78,6 +104,43 @@ class KnapsackModel:
     
     def reward(self, state, decision):
         return decision * self.instance.v[state.depth]
+
+    def successors_batch(self, states, depth):
+        # expands a whole layer at once, returns the parent index, decision, reward and
+        # successor of each feasible transition, equal successors share the same state object
+        w = self.instance.w[depth]
+        v = self.instance.v[depth]
+        parents = array('q')
+        decisions = array('q')
+        rewards = array('q')
+        successors = []
+        created = dict()
+        for parent, state in enumerate(states):
+            for decision in range(self.instance.q[depth] + 1):
+                capa = state.capa - decision * w
+                if capa < 0:
+                    break
+                successor = created.get(capa)
+                if successor is None:
+                    successor = KnapsackState(capa, depth + 1)
+                    created[capa] = successor
+                parents.append(parent)
+                decisions.append(decision)
+                rewards.append(decision * v)
+                successors.append(successor)
+        return (parents, decisions, rewards, successors)
+    
+    def keys(self, states):
+        # (capa, depth) packed in one int, the layers and the cache hash these instead of the states
+        m = self.instance.n + 1
+        return [state.capa * m + state.depth for state in states]
+
+    def depth_of(self, key): # depth of a key of keys(), used by ThresholdCache(eviction=Eviction.DEPTH)
+        return key % (self.instance.n + 1)
+
+    def state_of(self, key): # inverse of keys(), checkpoints store the keys of the states
+        (capa, depth) = divmod(key, self.instance.n + 1)
+        return KnapsackState(capa, depth)
     
     def merge(self, a, b):
         a.capa = max(a.capa, b.capa)
@@ -88,24 +151,35 @@ class KnapsackModel:
             return self.lp_bound(state)
         else:
             return self.simple_bound(state)
+
+    def rough_upper_bounds(self, states, depth):
+        if USE_LP_BOUND:
+            return self.lp_bounds([state.capa for state in states], depth)
+        else:
+            return self.simple_bounds([state.capa for state in states], depth)
     
     def lp_bound(self, state): # needs the items to be sorted by decreasing v/w ratio
-        capa = state.capa
-        rub = 0
-        for depth in range(state.depth, self.instance.n):
-            if self.instance.w[depth] * self.instance.q[depth] <= capa:
-                capa -= self.instance.w[depth] * self.instance.q[depth]
-                rub += self.instance.v[depth] * self.instance.q[depth]
-            else:
-                rub += int(math.floor(capa * self.instance.v[depth] / self.instance.w[depth]))
-                break
-        return rub
+        return self.lp_bounds([state.capa], state.depth)[0]
+
+    def lp_bounds(self, capas, depth):
+        # the items that fit entirely are those whose prefix weight from depth is at most capa,
+        # the first one that does not fit (the break item) is found by binary search
+        n = self.instance.n
+        rubs = array('q')
+        for capa in capas:
+            end = bisect.bisect_right(self.weights, capa + self.weights[depth], depth + 1, n + 1) - 1
+            rub = self.values[end] - self.values[depth]
+            if end < n:
+                capa -= self.weights[end] - self.weights[depth]
+                rub += int(math.floor(capa * self.instance.v[end] / self.instance.w[end]))
+            rubs.append(rub)
+        return rubs
 
     def simple_bound(self, state):
-        rub = 0
-        for depth in range(state.depth, self.instance.n):
-            rub += self.instance.v[depth] * self.instance.q[depth]
-        return rub
+        return self.values[self.instance.n] - self.values[state.depth]
+
+    def simple_bounds(self, capas, depth):
+        return array('q', [self.values[self.instance.n] - self.values[depth]]) * len(capas)
 
 class KnapsackDominance:
     def key(self, state):
@@ -119,3 +193,6 @@ class KnapsackDominance:
     
     def use_value(self):
         return True
+
+    def is_ordered(self): # check(a, b) compares value(a) and value(b)
+        return True
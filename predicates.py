@@ -0,0 +1,109 @@
+import math
+import re
+
+# conditions on the sequence of diagrams compiled by a Solver, each one is given every new
+# diagram with its index and tells whether it is already satisfied (True), can no longer be
+# satisfied (False) or is still undecided (None) so that the solver can stop early, final()
+# gets the total number of diagrams, reset() is called before each solve so that a predicate
+# can be reused
+
+class DD:
+    # condition on the index-th diagram, decided as soon as it is compiled
+    def __init__(self, index, condition, text=None):
+        self.index = index
+        self.condition = condition
+        self.text = text
+        self.result = None
+
+    def reset(self):
+        self.result = None
+
+    def update(self, index, dd):
+        if index == self.index:
+            self.result = bool(self.condition(dd))
+        return self.result
+
+    def final(self, count):
+        return self.result is True
+
+    def __str__(self):
+        return self.text or "dds[{}]".format(self.index)
+
+class Count:
+    # bounds on the number of diagrams, the upper bound is checked while solving
+    def __init__(self, min=0, max=math.inf, text=None):
+        self.min = min
+        self.max = max
+        self.text = text
+
+    def reset(self):
+        pass
+
+    def update(self, index, dd):
+        if index + 1 > self.max:
+            return False
+        return None
+
+    def final(self, count):
+        return self.min <= count <= self.max
+
+    def __str__(self):
+        return self.text or "{} <= len(dds) <= {}".format(self.min, self.max)
+
+class Any:
+    # condition satisfied by at least one diagram
+    def __init__(self, condition, text=None):
+        self.condition = condition
+        self.text = text
+        self.found = False
+
+    def reset(self):
+        self.found = False
+
+    def update(self, index, dd):
+        if not self.found:
+            self.found = bool(self.condition(dd))
+        return True if self.found else None
+
+    def final(self, count):
+        return self.found
+
+    def __str__(self):
+        return self.text or "any(dds)"
+
+def attribute(name, negate=False):
+    # condition reading an attribute of a diagram, or calling it when name ends with ()
+    if name.endswith("()"):
+        get = lambda dd: getattr(dd, name[:-2])()
+    else:
+        get = lambda dd: getattr(dd, name)
+    if negate:
+        return lambda dd: not get(dd)
+    return get
+
+COMPARISONS = {
+    "<": lambda n: Count(max=n - 1),
+    "<=": lambda n: Count(max=n),
+    "==": lambda n: Count(n, n),
+    ">=": lambda n: Count(min=n),
+    ">": lambda n: Count(min=n + 1),
+}
+
+def parse(text):
+    # understands "[not] dds[i].attr", "len(dds) <op> k" and "any([not] dd.attr for dd in dds)"
+    text = text.strip()
+    match = re.fullmatch(r"(not\s+)?dds\[(\d+)\]\.(\w+(?:\(\))?)", text)
+    if match:
+        return DD(int(match.group(2)), attribute(match.group(3), match.group(1) is not None), text)
+    match = re.fullmatch(r"len\(dds\)\s*(<=|<|==|>=|>)\s*(\d+)", text)
+    if match:
+        predicate = COMPARISONS[match.group(1)](int(match.group(2)))
+        predicate.text = text
+        return predicate
+    match = re.fullmatch(r"any\((not\s+)?dd\.(\w+(?:\(\))?)\s+for\s+dd\s+in\s+dds\)", text)
+    if match:
+        return Any(attribute(match.group(2), match.group(1) is not None), text)
+    raise ValueError("unknown predicate: " + text)
+
+def predicates(*conditions):
+    return [parse(c) if isinstance(c, str) else c for c in conditions]
@@ -1,40 +1,340 @@
-from queue import PriorityQueue
+import heapq
+import multiprocessing
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from checkpoint import *
 from dd import *
+from dp import *
 
 class Settings:
-    def __init__(self, width=math.inf, cutset=Cutset.LAYER, use_rub=False, use_locb=False, use_cache=False, use_dominance=False):
+    def __init__(self, width=math.inf, cutset=Cutset.LAYER, use_rub=False, use_locb=False, use_cache=False, use_dominance=False, compact=False, ranking=rank_by_value_top, dominance_handles=True, dominance_max_size=math.inf, headless=False, profile=False, filters=FILTERS, dp_variables=0):
         self.width = width
         self.cutset = cutset
         self.use_rub = use_rub
         self.use_locb = use_locb
         self.use_cache = use_cache
         self.use_dominance = use_dominance
+        self.compact = compact # ArrayLayer engine: about 40% less memory per node, pays off for wide diagrams (thousands of nodes per layer), slower for narrow ones
+        self.ranking = ranking
+        self.dominance_handles = dominance_handles
+        self.dominance_max_size = dominance_max_size
+        self.headless = headless # only keep what the search needs, the diagrams can no longer be drawn
+        self.profile = profile
+        self.filters = filters
+        self.dp_variables = dp_variables # subproblems with at most this many variables left are solved by dynamic programming
+
+class AdaptiveWidth:
+    # chooses the width of each subproblem: the base width is multiplied or divided by factor when
+    # the last subproblem took less than half or more than twice target_time to compile, then it is
+    # made larger deep in the tree where subproblems are smaller, and smaller when the gap between
+    # the incumbent and the bound of the subproblem is small or when most of the last relaxed
+    # diagrams were exact, both meaning that a narrower diagram is likely enough
+    def __init__(self, width, min_width=2, max_width=math.inf, target_time=0.1, factor=1.5, window=10, small_gap=0.01):
+        if not math.isfinite(width):
+            raise ValueError("AdaptiveWidth needs a finite base width")
+        self.width = width
+        self.min_width = min_width
+        self.max_width = max_width
+        self.target_time = target_time
+        self.factor = factor
+        self.small_gap = small_gap
+        self.exact = deque(maxlen=window)
+
+    def choose(self, nb_variables, root, best):
+        width = self.width * (1 + root.depth / nb_variables)
+        if math.isfinite(root.ub) and root.ub - best <= self.small_gap * max(abs(root.ub), 1):
+            width /= 2
+        if len(self.exact) > 0 and sum(self.exact) > len(self.exact) / 2:
+            width /= 2
+        return int(max(self.min_width, min(self.max_width, round(width))))
+
+    def update(self, elapsed, exact):
+        self.exact.append(exact)
+        if elapsed > 2 * self.target_time:
+            self.width = max(self.min_width, self.width / self.factor)
+        elif elapsed < self.target_time / 2 and not exact:
+            self.width = min(self.max_width, self.width * self.factor)
+
+class Budget:
+    # limits of a search, checked before each subproblem: wall-clock seconds, number of subproblems
+    # and estimated bytes of the frontier and of the threshold cache, the time and memory are also
+    # checked between the layers of each diagram, with its nodes counted in the memory
+    def __init__(self, seconds=math.inf, nodes=math.inf, memory=math.inf):
+        self.seconds = seconds
+        self.nodes = nodes
+        self.memory = memory
+
+    def exceeded(self, solver):
+        # name of the first limit reached, None if there is none
+        if time.perf_counter() - solver.start >= self.seconds:
+            return "seconds"
+        if solver.explored >= self.nodes:
+            return "nodes"
+        if self.memory < math.inf and solver.memory() >= self.memory:
+            return "memory"
+        return None
+
+    def interrupted(self, elapsed, memory):
+        # limit reached while compiling a diagram, memory is only computed when it is bounded
+        if elapsed >= self.seconds:
+            return "seconds"
+        if self.memory < math.inf and memory() >= self.memory:
+            return "memory"
+        return None
+
+def relative_gap(best, bound):
+    if bound == best:
+        return 0
+    if bound == math.inf or bound == 0:
+        return math.inf
+    return (bound - best) / abs(bound)
+
+class Frontier:
+    # max-heap on ub without locking, entries whose ub cannot beat the best value are
+    # purged in bulk and only the node with the largest value_top is kept for each state
+    def __init__(self, merge_duplicates=True):
+        self.heap = []
+        self.live = dict()
+        self.merge_duplicates = merge_duplicates
+
+        self.pushed = 0
+        self.popped = 0
+        self.merged = 0
+        self.purged = 0
+        self.peak = 0
+
+    def push(self, node):
+        self.pushed += 1
+        if self.merge_duplicates:
+            current = self.live.get(node.state)
+            if current is not None:
+                self.merged += 1
+                if current.value_top >= node.value_top:
+                    return
+            self.live[node.state] = node
+        heapq.heappush(self.heap, (- node.ub, node))
+        self.peak = max(self.peak, len(self.heap))
+
+    def pop(self):
+        while True:
+            node = heapq.heappop(self.heap)[1]
+            if not self.merge_duplicates:
+                break
+            if self.live.get(node.state) is node:
+                del self.live[node.state]
+                break
+        self.popped += 1
+        return node
+
+    def prune(self, best):
+        size = len(self.heap)
+        self.heap = [entry for entry in self.heap if - entry[0] > best and (not self.merge_duplicates or self.live.get(entry[1].state) is entry[1])]
+        heapq.heapify(self.heap)
+        if self.merge_duplicates:
+            self.live = {entry[1].state: entry[1] for entry in self.heap}
+        self.purged += size - len(self.heap)
+
+    def max_ub(self):
+        # stale entries on top of the heap are dropped, pop() would skip them anyway
+        while len(self.heap) > 0 and self.merge_duplicates and self.live.get(self.heap[0][1].state) is not self.heap[0][1]:
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return -math.inf
+        return - self.heap[0][0]
+
+    def nodes(self):
+        if self.merge_duplicates:
+            return list(self.live.values())
+        return [entry[1] for entry in self.heap]
+
+    def __len__(self):
+        if self.merge_duplicates:
+            return len(self.live)
+        return len(self.heap)
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "entries": len(self.heap),
+            "peak": self.peak,
+            "pushed": self.pushed,
+            "popped": self.popped,
+            "merged": self.merged,
+            "purged": self.purged,
+            "bytes": sys.getsizeof(self.heap) + sys.getsizeof(self.live) + len(self.heap) * (sys.getsizeof((0, None)) + sys.getsizeof(Node(None))),
+        }
 
 class Solver:
-    def __init__(self, model, dominance_rule, settings):
-        self.input = CompilationInput(model, dominance_rule, None, 0, dict(), dict(), False, settings)
+    def __init__(self, model, dominance_rule, settings, cache=None, keep_dds=False, callback=None, rubs=None, width_policy=None, on_incumbent=None):
+        # rubs is an optional BoundCache memoizing the rough upper bounds, width_policy an optional
+        # AdaptiveWidth that replaces the width of the settings, on_incumbent is given incumbent()
+        # each time the best value improves
+        if cache is None:
+            cache = ThresholdCache()
+        if cache.depth is None:
+            cache.depth = key_depth(model)
+        self.input = CompilationInput(model, dominance_rule, None, 0, cache, dict(), False, settings, rubs)
         self.dds = []
-        self.queue = PriorityQueue()
+        self.keep_dds = keep_dds
+        self.callback = callback
+        self.queue = Frontier()
+        self.profile = Profile() # totals of the diagrams compiled with Settings.profile
+        self.width_policy = width_policy
+        self.on_incumbent = on_incumbent
+
+        self.start = time.perf_counter()
+        self.explored = 0 # subproblems compiled
+        self.active = [] # subproblems being compiled, their ub still bounds the search
+        self.stopped = None # name of the budget limit that stopped the search
+        self.best_path = None # path (see path_of()) of the incumbent, when it is known
+        self.best_path_value = None
+        self.resumed = False # the queue was restored by resume(), the search does not start from the root
+    
+    def bound(self):
+        # global upper bound: the best value or the largest ub of an open subproblem
+        return max([self.input.best, self.queue.max_ub()] + [node.ub for node in self.active])
+
+    def memory(self):
+        return self.queue.stats()["bytes"] + self.input.cache.stats()["bytes"]
+
+    def incumbent(self):
+        bound = self.bound()
+        return {
+            "best": self.input.best,
+            "bound": bound,
+            "gap": relative_gap(self.input.best, bound),
+            "seconds": time.perf_counter() - self.start,
+            "nodes": self.explored,
+            "stopped": self.stopped,
+            "solution": self.solution(),
+        }
+
+    def solution(self):
+        # decisions of the best solution found, from the first variable to the last
+        if self.best_path is None:
+            return None
+        return path_decisions(self.best_path)
+
+    def stats(self):
+        stats = {
+            "frontier": self.queue.stats(),
+            "cache": self.input.cache.stats(),
+        }
+        if self.input.rubs is not None:
+            stats["rubs"] = self.input.rubs.stats()
+        return stats
     
+    def resume(self, file):
+        # continues the search saved by a Checkpoint, call it before solve()
+        with open(file, "rb") as fd:
+            read_checkpoint(self, fd)
+        self.resumed = True
+
+    def start_search(self):
+        if not self.resumed:
+            self.enqueue(Node(self.input.model.root(), path=()))
+        self.resumed = False
+
     def enqueue(self, node):
-        self.queue.put((- node.ub, node))
+        self.queue.push(node)
     
     def dequeue(self):
-        return self.queue.get()[1]
+        return self.queue.pop()
     
     def finished(self):
-        return self.queue.empty()
+        return len(self.queue) == 0
     
     def update_best(self, dd):
         best = dd.get_best_value()
         if best is not None and best > self.input.best:
-            self.input.best = best
+            self.set_best(best, dd.get_best_path())
+
+    def set_best(self, best, path=None):
+        if path is not None:
+            self.set_best_path(best, path)
+        self.input.best = best
+        self.queue.prune(best)
+        if self.on_incumbent is not None:
+            self.on_incumbent(self.incumbent())
+
+    def set_best_path(self, best, path):
+        # in parallel the best value can be known before the path that leads to it
+        if self.best_path_value is None or best > self.best_path_value:
+            self.best_path = path
+            self.best_path_value = best
+
+    def interrupt(self, budget, dd):
+        return budget.interrupted(time.perf_counter() - self.start, lambda: self.memory() + dd.memory())
+
+    def worker_budget(self, budget):
+        # time left and memory limit for a subproblem compiled by a worker, None if there is no limit on them
+        if budget is None or (budget.seconds == math.inf and budget.memory == math.inf):
+            return None
+        return Budget(seconds=budget.seconds - (time.perf_counter() - self.start), memory=budget.memory)
+
+    def abandon(self, limit, checkpoint):
+        # the subproblem being compiled goes back to the frontier, unexplored
+        root = self.input.root
+        self.enqueue(Node(root.state, root.depth, root.value_top, ub=root.ub, path=root.path))
+        self.explored -= 1
+        self.active = []
+        self.stopped = limit
+        if checkpoint is not None:
+            checkpoint.write(self)
+
+    def adapt(self, elapsed, exact):
+        # feedback of the last subproblem for the width policy
+        if self.width_policy is not None:
+            self.width_policy.update(elapsed, exact)
 
-    def solve(self, settings=None, restricted_its=None):
+    def solve(self, settings=None, restricted_its=None, predicates=None, budget=None, checkpoint=None):
+        # diagrams are only kept in self.dds with keep_dds, the callback sees each of them,
+        # stops as soon as one of the predicates cannot be satisfied anymore and
+        # returns whether they all hold, incumbent() tells where the search stopped with a budget
+        if predicates is None:
+            predicates = []
+        for predicate in predicates:
+            predicate.reset()
+        count = 0
+        for dd in self.diagrams(settings, restricted_its, budget, checkpoint):
+            if self.keep_dds:
+                self.dds.append(dd)
+            if self.callback is not None:
+                self.callback(dd)
+            if any(predicate.update(count, dd) is False for predicate in predicates):
+                return False
+            count += 1
+        return all(predicate.final(count) for predicate in predicates)
+
+    def incumbents(self, settings=None, budget=None, checkpoint=None):
+        # anytime search, yields incumbent() each time the best value improves and once at the end
+        best = self.input.best
+        for dd in self.diagrams(settings, None, budget, checkpoint):
+            if self.input.best > best:
+                best = self.input.best
+                yield self.incumbent()
+        yield self.incumbent()
+
+    def diagrams(self, settings=None, restricted_its=None, budget=None, checkpoint=None):
+        # generator over the restricted and relaxed diagrams in the order they are compiled,
+        # a checkpoint is written between two subproblems and when the budget stops the search
         it = -1
-        self.enqueue(Node(self.input.model.root()))
+        self.start = time.perf_counter()
+        self.start_search()
+        self.input.interrupt = None if budget is None else lambda dd: self.interrupt(budget, dd)
 
         while not self.finished():
+            self.active = []
+            if budget is not None:
+                self.stopped = budget.exceeded(self)
+                if self.stopped is not None:
+                    if checkpoint is not None:
+                        checkpoint.write(self)
+                    return
+            if checkpoint is not None:
+                checkpoint.tick(self)
             it += 1
 
             self.input.root = self.dequeue()
@@ -42,28 +342,247 @@ class Solver:
             if self.input.root.ub <= self.input.best:
                 continue
 
+            self.active = [self.input.root]
+            self.explored += 1
+
             if settings is not None and it < len(settings):
                 self.input.settings = settings[it]
 
+            if self.input.model.nb_variables() - self.input.root.depth <= self.input.settings.dp_variables:
+                (best, decisions) = solve_dp(self.input.model, self.input.root, True)
+                if best is not None and best > self.input.best:
+                    self.set_best(best, extend_path(self.input.root.path, decisions))
+                continue
+
+            if self.width_policy is not None:
+                self.input.adapted_width = self.width_policy.choose(self.input.model.nb_variables(), self.input.root, self.input.best)
+
             self.input.relaxed = False
+            prefix = None
+            elapsed = 0
 
             if restricted_its is None or it in restricted_its:
-                restricted = Diagram(self.input)
-                self.dds.append(restricted)
-
-                self.update_best(restricted)
+                best = self.input.best
+                start = time.perf_counter()
+                try:
+                    restricted = Diagram(self.input)
+                except Interrupted as interrupted:
+                    self.abandon(interrupted.limit, checkpoint)
+                    return
+                elapsed = time.perf_counter() - start
+                self.profile.add(restricted.profile, "restricted")
+                self.update_best(restricted) # before the yield so that incumbents() reports it right away
+                yield restricted
 
                 if restricted.is_exact():
+                    self.adapt(elapsed, True)
                     continue
 
-            self.input.relaxed = True
+                prefix = warm_start_prefix(restricted, best, self.input)
 
-            relaxed = Diagram(self.input)
-            self.dds.append(relaxed)
+            self.input.relaxed = True
 
+            start = time.perf_counter()
+            try:
+                relaxed = Diagram(self.input, prefix)
+            except Interrupted as interrupted:
+                self.abandon(interrupted.limit, checkpoint)
+                return
+            self.adapt(elapsed + time.perf_counter() - start, relaxed.is_exact())
+            self.profile.add(relaxed.profile, "relaxed")
             if relaxed.is_exact():
                 self.update_best(relaxed)
-            else:
+            yield relaxed
+
+            if not relaxed.is_exact():
                 cutset = relaxed.get_cutset()
                 for node in cutset:
-                    self.enqueue(Node(node.state, node.depth, node.value_top, ub=node.ub))
\ No newline at end of file
+                    self.enqueue(Node(node.state, node.depth, node.value_top, ub=node.ub, path=path_of(node)))
+        self.active = []
+
+    def solve_parallel(self, workers=None, budget=None, checkpoint=None):
+        # the best value and the thresholds are shared: the thresholds of each subproblem are added
+        # to the cache of the solver, which is published as a snapshot once enough of them were
+        # received, the workers read the snapshot before a subproblem when it changed, each worker
+        # keeps its own dominance store and a cache bounded like the one of the solver,
+        # once the budget is exceeded no new subproblem is started and the running ones are
+        # abandoned between two layers and put back in the frontier,
+        # the subproblems being compiled are saved in the checkpoints as open ones
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        shared_best = multiprocessing.Value('d', self.input.best)
+        self.start = time.perf_counter()
+        self.start_search()
+
+        with multiprocessing.Manager() as manager:
+            cache = self.input.cache
+            snapshot = manager.Namespace(version=0, rows=threshold_rows(cache.items()))
+            received = 0 # thresholds added to the cache since the last snapshot
+            with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self.input.model, self.input.dominance_rule, self.input.settings, shared_best, self.input.rubs, (cache.max_entries, cache.max_bytes, cache.eviction), snapshot)) as executor:
+                running = dict() # future -> subproblem
+                while not self.finished() or len(running) > 0:
+                    while not self.finished() and len(running) < workers:
+                        if budget is not None and self.stopped is None:
+                            self.stopped = budget.exceeded(self)
+                        if self.stopped is not None:
+                            break
+                        node = self.dequeue()
+                        if node.ub <= self.input.best:
+                            continue
+                        self.explored += 1
+                        # the worker gets a root with an empty path and sends back the decisions below it
+                        root = Node(node.state, node.depth, node.value_top, ub=node.ub, path=())
+                        running[executor.submit(solve_subproblem, root, self.worker_budget(budget))] = node
+                    self.active = list(running.values())
+
+                    if len(running) == 0:
+                        break
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        (best, cutset, profile, found, stopped, thresholds) = future.result()
+                        root = running[future]
+                        self.profile.add(profile)
+                        if stopped is not None:
+                            self.explored -= 1
+                            self.stopped = self.stopped or stopped
+                        add_thresholds(cache, thresholds)
+                        received += len(thresholds)
+                        if received > 0 and received >= SNAPSHOT_RATIO * len(cache):
+                            snapshot.rows = threshold_rows(cache.items())
+                            snapshot.version += 1
+                            received = 0
+                        if found is not None:
+                            self.set_best_path(found[0], extend_path(root.path, found[1]))
+                        if best > self.input.best:
+                            self.set_best(best)
+                        for (state, depth, value_top, ub, decisions) in cutset:
+                            if ub > self.input.best:
+                                self.enqueue(Node(state, depth, value_top, ub=ub, path=extend_path(root.path, decisions)))
+                        del running[future]
+                        self.active = list(running.values())
+
+                    with shared_best.get_lock():
+                        best = number(shared_best.value)
+                    if best > self.input.best:
+                        self.set_best(best)
+                    if checkpoint is not None:
+                        checkpoint.tick(self)
+        if checkpoint is not None and self.stopped is not None:
+            checkpoint.write(self)
+
+def warm_start_prefix(restricted, best, input):
+    # the prefix was filtered with the former best value, with a better one the rough upper bounds could prune more of it
+    if input.settings.use_rub and input.best != best:
+        return None
+    return restricted.prefix
+
+worker_input = None
+worker_best = None
+worker_snapshot = None
+worker_version = None # version of worker_snapshot already added to the cache of this worker
+
+# a new snapshot of the cache of the solver is published once the thresholds received since the
+# last one reach this fraction of its size, so copying the snapshots costs O(1) per threshold
+SNAPSHOT_RATIO = 0.25
+
+def init_worker(model, dominance_rule, settings, shared_best, rubs, cache_config, snapshot):
+    global worker_input, worker_best, worker_snapshot, worker_version
+    (max_entries, max_bytes, eviction) = cache_config
+    cache = ThresholdCache(max_entries, max_bytes, eviction, depth=key_depth(model))
+    worker_input = CompilationInput(model, dominance_rule, None, 0, cache, dict(), False, settings, rubs)
+    worker_best = shared_best
+    worker_snapshot = snapshot
+    worker_version = None
+
+def threshold_rows(entries):
+    # (state, Threshold) pairs as plain tuples to send them to other processes
+    return [(state, threshold.theta, threshold.value_top, threshold.pruning) for state, threshold in entries]
+
+def add_thresholds(cache, rows):
+    # thresholds found by other workers, each one is valid for the whole search, the one that prunes
+    # the most is kept when a state has several
+    for (state, theta, value_top, pruning) in rows:
+        if state not in cache or cache[state].theta < theta:
+            cache[state] = Threshold(theta, value_top, pruning)
+
+def receive_thresholds():
+    # the snapshot can be replaced between the two reads, its thresholds are valid all the same
+    global worker_version
+    version = worker_snapshot.version
+    if version != worker_version:
+        add_thresholds(worker_input.cache, worker_snapshot.rows)
+        worker_version = version
+
+def publish_best(best, path):
+    # returns (best, decisions of path) when best improves the value known to this worker, the
+    # paths are sent as flat lists since pickling deeply nested tuples overflows the stack
+    found = None
+    if best is not None and best > worker_input.best:
+        found = (best, path_decisions(path))
+    with worker_best.get_lock():
+        if best is not None and best > worker_best.value:
+            worker_best.value = best
+        worker_input.best = max(worker_input.best, number(worker_best.value))
+    return found
+
+def solve_subproblem(root, budget):
+    # also returns the thresholds set while solving root so that the other workers get them,
+    # budget only holds the time left and the memory limit, checked between the layers
+    if budget is None:
+        worker_input.interrupt = None
+    else:
+        start = time.perf_counter()
+        worker_input.interrupt = lambda dd: budget.interrupted(time.perf_counter() - start, lambda: worker_input.cache.stats()["bytes"] + dd.memory())
+    if not worker_input.settings.use_cache:
+        return explore_subproblem(root) + ([],)
+    receive_thresholds()
+    worker_input.cache.journal = dict()
+    result = explore_subproblem(root)
+    rows = threshold_rows(worker_input.cache.journal.items())
+    worker_input.cache.journal = None
+    return result + (rows,)
+
+def explore_subproblem(root):
+    # returns the best value, the cutset, the profile, the improved solution and the limit that
+    # interrupted the compilation, the root is then sent back as the only cutset node
+    input = worker_input
+    with worker_best.get_lock():
+        input.best = max(input.best, number(worker_best.value))
+
+    profile = Profile()
+    input.root = root
+    if root.ub <= input.best:
+        return (input.best, [], profile, None, None)
+
+    if input.model.nb_variables() - root.depth <= input.settings.dp_variables:
+        (best, decisions) = solve_dp(input.model, root, True)
+        path = None if best is None else extend_path(root.path, decisions)
+        found = publish_best(best, path)
+        return (input.best, [], profile, found, None)
+
+    unexplored = [(root.state, root.depth, root.value_top, root.ub, [])]
+
+    input.relaxed = False
+    best = input.best
+    try:
+        restricted = Diagram(input)
+    except Interrupted as interrupted:
+        return (input.best, unexplored, profile, None, interrupted.limit)
+    profile.add(restricted.profile, "restricted")
+    found = publish_best(restricted.get_best_value(), restricted.get_best_path())
+    if restricted.is_exact():
+        return (input.best, [], profile, found, None)
+
+    input.relaxed = True
+    try:
+        relaxed = Diagram(input, warm_start_prefix(restricted, best, input))
+    except Interrupted as interrupted:
+        return (input.best, unexplored, profile, found, interrupted.limit)
+    profile.add(relaxed.profile, "relaxed")
+    if relaxed.is_exact():
+        found = publish_best(relaxed.get_best_value(), relaxed.get_best_path()) or found
+        return (input.best, [], profile, found, None)
+
+    # send back plain tuples, the cutset nodes reference the whole diagram
+    return (input.best, [(node.state, node.depth, node.value_top, node.ub, path_decisions(path_of(node))) for node in relaxed.get_cutset()], profile, found, None)
@@ -0,0 +1,34 @@
+import math
+import random
+
+import pytest
+
+import dd
+from dd import *
+from knapsack import *
+
+def add_all(front, states, tops, handles, monkeypatch, ratio):
+    # ratio 0 inserts the batch node by node, a huge ratio merges it
+    monkeypatch.setattr(dd, "PARETO_MERGE_RATIO", ratio)
+    return front.add_all(states, tops, handles)
+
+@pytest.mark.parametrize("max_size", [math.inf, 5, 30])
+@pytest.mark.parametrize("handles", [False, True])
+def test_merge_and_insert_agree(max_size, handles, monkeypatch):
+    rand = random.Random(1)
+    rule = KnapsackDominance()
+    for _ in range(300):
+        merged = ParetoFront(rule, handles, max_size)
+        inserted = ParetoFront(rule, handles, max_size)
+        for step in range(rand.randint(1, 8)):
+            k = rand.randint(1, 12)
+            batch = sorted([(rand.randint(0, 60), rand.randint(0, 60)) for _ in range(k)], reverse=True)
+            states = [KnapsackState(capa, 0) for capa, _ in batch]
+            tops = [value_top for _, value_top in batch]
+            ids = list(range(100 * step, 100 * step + k))
+
+            assert add_all(merged, states, tops, ids, monkeypatch, 10**9) == add_all(inserted, states, tops, ids, monkeypatch, 0)
+            assert list(merged.values) == list(inserted.values)
+            assert list(merged.tops) == list(inserted.tops)
+            assert merged.handles == inserted.handles
+            assert len(merged) <= max_size
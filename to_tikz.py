@@ -34,17 +34,17 @@ def main():
     for i in range(len(settings)):
         setting = settings[i]
 
-        solver = Solver(model, dominance_rule, None)
+        solver = Solver(model, dominance_rule, None, keep_dds=True)
         solver.solve(setting, [0])
 
         all_dds.append(solver.dds)
 
-    solver = Solver(model, dominance_rule, None)
+    solver = Solver(model, dominance_rule, None, keep_dds=True)
     solver.solve([Settings(width, cutset=Cutset.LAYER, use_rub=False, use_locb=False, use_cache=False, use_dominance=False)])
 
     all_dds.append(solver.dds)
 
-    Tikz.to_file(Tikz(Diagram(CompilationInput(model, dominance_rule, Node(model.root()), 0, dict(), dict(), False, Settings())), state_fmt=state_fmt, show_thresholds=False, show_layer_label=True, show_variable_label=True, arcs_sep_angle=80, legend="(b) Exact DD", node_labels={
+    Tikz.to_file(Tikz(Diagram(CompilationInput(model, dominance_rule, Node(model.root()), 0, ThresholdCache(), dict(), False, Settings())), state_fmt=state_fmt, show_thresholds=False, show_layer_label=True, show_variable_label=True, arcs_sep_angle=80, legend="(b) Exact DD", node_labels={
             KnapsackState(15, 1): "a_1",
             KnapsackState(11, 1): "a_2",
     }, arc_positions={